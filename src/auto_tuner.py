@@ -7,7 +7,6 @@ from ray.tune.schedulers import AsyncHyperBandScheduler
 from ray.tune.search.ax import AxSearch
 
 import sim
-import lang
 import paint 
 
 def main():
@@ -15,18 +14,18 @@ def main():
     parser.add_argument('-i', '--input', type=str, required=True)
     parser.add_argument('-o', '--output', type=str, required=True)
     parser.add_argument('-n', '--num_samples', type=int, default=25)
+    parser.add_argument('--no-cache', action='store_true', help='always re-solve grid colors')
     args = parser.parse_args()
+    if args.no_cache:
+        paint.COLOR_CACHE = None
 
     
-    img = paint.load(args.input)
+    img = paint.load_mapped(args.input)
 
 
-    def score_cmds(cmds):
-        state = sim.State(400, 400, {
-            '0': sim.make_filled_block(0, 0, 400, 400, (255,255,255,255))
-        })
+    def score_moves(moves):
+        state = sim.blank_state()
 
-        moves = lang.parse_lines(cmds)
         res = sim.run_program(state, moves)
         diff_cost = round(paint.diff_cost(img, res['output']))
         return res['cost'] + diff_cost
@@ -35,9 +34,9 @@ def main():
     def objective(config):
         paint.NBLOCKS = config["num_blocks"]
         
-        cmds = paint.solve(img, config["orient"], (config["bleed_a" ], config["bleed_b"]))
+        moves = paint.solve_moves(img, config["orient"], (config["bleed_a" ], config["bleed_b"]))
 
-        cost = score_cmds(cmds)
+        cost = score_moves(moves)
         session.report({
             'cost': cost
         })
@@ -75,9 +74,11 @@ def main():
     paint.NBLOCKS = best_config["num_blocks"]
     cmds = paint.solve(img, best_config["orient"], (best_config["bleed_a" ], best_config["bleed_b"]))
     with open(args.output, "w") as f:
-        f.writelines([c + "\n" for c in cmds])
+        f.writelines(c + "\n" for c in cmds)
         
     print(f"Best config: {best_config}")
+    if paint.COLOR_CACHE is not None:
+        paint.eprint(paint.COLOR_CACHE.stats())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,185 @@
+# Solves a whole problem set in one go: every problem runs the chosen planners
+# in a process pool, every candidate is scored with the simulator, and the
+# best program per problem goes to the output directory. Scores are recorded
+# in batch.json there as each problem finishes, so a rerun skips problems that
+# are already done and a crash only loses the problems still in flight.
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import time
+
+import breakpoints
+import grid_sweep
+import guillotine
+import lang
+import paint
+import problems
+import sim
+import swapper_soln
+
+# Planners take the target image and the starting blocks of an initial state
+# (None for the blank canvas) and return moves, or None when they do not
+# apply. The grid planners all start from the blank canvas's block 0.
+def plan_empty(img, blocks):
+    return []
+
+def plan_grid(img, blocks):
+    if blocks is not None:
+        return None
+    _, n, orient, bleed = grid_sweep.sweep(img, max_bleed=16)
+    color_blocks, _, _ = paint.grid_colors(img, n)
+    return paint.grid_moves(img.shape, color_blocks, orient, bleed)
+
+def plan_breakpoints(img, blocks):
+    if blocks is not None:
+        return None
+    _, ori, xs, ys = breakpoints.optimize(img, step=4)
+    return paint.solve_breaks_moves(img, xs, ys, ori)
+
+def plan_guillotine(img, blocks):
+    if blocks is not None:
+        return None
+    planner = guillotine.Planner(img, step=20, max_depth=6)
+    planner.plan()
+    return planner.emit()
+
+def plan_swaps(img, blocks):
+    if blocks is None:
+        return None
+    moves, _ = swapper_soln.solve_swap_moves(blocks, img)
+    return moves
+
+PLANNERS = {
+    'empty': plan_empty,
+    'grid': plan_grid,
+    'breakpoints': plan_breakpoints,
+    'guillotine': plan_guillotine,
+    'swaps': plan_swaps,
+}
+
+RESULTS = 'batch.json'
+
+def problem_id(fname):
+    return re.match(r'(\d+)', os.path.basename(fname)).group(1)
+
+def initial_state_fname(fname):
+    f = os.path.join(os.path.dirname(fname), problem_id(fname) + '.initial.json')
+    return f if os.path.exists(f) else None
+
+def start_state(initial):
+    if initial is None:
+        return sim.blank_state()
+    return sim.load_state(initial)
+
+# Runs every planner on one problem, writing each candidate to a temporary
+# file while it is scored. The best one replaces `out` if it beats `prev`.
+# Returns {'pid', 'scores' (or errors) by planner, 'planner', 'score'}.
+def solve_problem(fname, planners, out, prev=None):
+    img = paint.load_mapped(fname)
+    initial = initial_state_fname(fname)
+    # swapper_soln reads block colors from their pixel buffers
+    blocks = sim.load_state(initial, backend='blocks').blocks if initial is not None else None
+    scores = {}
+    best = (prev, None, None)
+    for name in planners:
+        tmp = f'{out}.{name}.{os.getpid()}.tmp'
+        try:
+            moves = PLANNERS[name](img, blocks)
+            if moves is None:
+                continue
+            with open(tmp, 'w') as f:
+                res = sim.run_program(start_state(initial), lang.write_moves(f, moves))
+            score = res['cost'] + round(paint.diff_cost(img, res['output']))
+        except Exception as e:
+            scores[name] = f'{type(e).__name__}: {e}'
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            continue
+        scores[name] = score
+        if best[0] is None or score < best[0]:
+            if best[2] is not None:
+                os.remove(best[2])
+            best = (score, name, tmp)
+        else:
+            os.remove(tmp)
+    score, name, tmp = best
+    if tmp is not None:
+        os.replace(tmp, out)
+    return {'pid': problem_id(fname), 'scores': scores, 'planner': name, 'score': score}
+
+def load_results(fname):
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        return json.load(f)
+
+def save_results(results, fname):
+    tmp = fname + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    os.replace(tmp, fname)
+
+def print_summary(results):
+    tot_score = 0
+    for pid in sorted(results, key=int):
+        r = results[pid]
+        print(f'{pid} ({r["planner"]}): {r["score"]}')
+        tot_score += r['score']
+    print(f'== Total: {tot_score} ==')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fnames', type=str, nargs='*',
+                        help='problem PNGs (default: every PNG in the repo\'s problems/)')
+    parser.add_argument('-o', '--output', type=str, default=problems.PROGS_DIR,
+                        help='directory for the best programs and ' + RESULTS +
+                             ' (default: the repo\'s progs/)')
+    parser.add_argument('-p', '--planners', type=str, default='empty,grid,breakpoints,guillotine,swaps',
+                        help='comma separated planners, from ' + ','.join(PLANNERS))
+    parser.add_argument('--suffix', type=str, default='batch',
+                        help='programs are written as <problem>_<suffix>.isl')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='re-solve problems that already have a result')
+    args = parser.parse_args()
+    planners = args.planners.split(',')
+    for name in planners:
+        if name not in PLANNERS:
+            parser.error(f'unknown planner {name}')
+
+    fnames = args.fnames or problems.all_problems()
+    if not fnames:
+        parser.error(f'no problem PNGs in {problems.PROBLEMS_DIR}')
+    fnames = sorted(fnames, key=lambda f: int(problem_id(f)))
+    results_fname = os.path.join(args.output, RESULTS)
+    results = load_results(results_fname)
+    out = lambda f: os.path.join(args.output, f'{problem_id(f)}_{args.suffix}.isl')
+    todo = [f for f in fnames
+            if args.force or problem_id(f) not in results or not os.path.exists(out(f))]
+    print(f'{len(fnames) - len(todo)} problems already done, solving {len(todo)}')
+
+    start = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {}
+        for f in todo:
+            prev = results.get(problem_id(f))
+            prev = prev['score'] if prev is not None and os.path.exists(out(f)) else None
+            futures[pool.submit(solve_problem, f, planners, out(f), prev)] = f
+        for fut in concurrent.futures.as_completed(futures):
+            f = futures[fut]
+            try:
+                r = fut.result()
+            except Exception as e:
+                print(f'{f}: failed, {type(e).__name__}: {e}')
+                continue
+            print(f'{f}: {r["scores"]} ({time.time()-start:.1f}s)')
+            if r['planner'] is not None:
+                results[r['pid']] = {'planner': r['planner'], 'score': r['score'],
+                                     'scores': r['scores']}
+                save_results(results, results_fname)
+    print_summary(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+# Beam search planner: grows programs one action at a time from the blank
+# canvas. An action recolors, line cuts or point cuts one of the blocks with
+# the largest similarity cost, cutting at the strongest image edges across the
+# block and coloring the parts with their mean colors from
+# regions.RegionStats. Every candidate is applied to its parent's simulator
+# state and scored exactly (state.checkpoint/rollback), and the beam keeps the
+# `width` cheapest programs so far. Runs until the time budget is spent.
+import argparse
+import concurrent.futures
+import copy
+import heapq
+import numpy as np
+import os
+import time
+
+import lang
+import paint
+import regions
+import sim
+
+# per process state: target image, its region stats, edge strength tables and
+# the simulator states of recently expanded search nodes by node id
+IMG = None
+STATS = None
+EDGES = None
+STATES = {}
+# actions node_state has replayed onto forks, to check forks stay shallow
+REPLAYED = 0
+
+def init_worker(fname):
+    global IMG, STATS, EDGES, REPLAYED
+    IMG = paint.load_mapped(fname)
+    STATS = regions.RegionStats.from_problem(fname)
+    EDGES = edge_tables(IMG)
+    REPLAYED = 0
+    STATES.clear()
+    STATES[0] = sim.blank_state(ref=IMG)
+
+# Summed color differences between neighbouring columns (ex) and rows (ey),
+# cumulated along the edge so that the strength of a cut over part of the
+# canvas is one subtraction: ex[x-1, y1] - ex[x-1, y0] for a cut at x
+# spanning y0..y1.
+def edge_tables(img):
+    img = np.asarray(img, dtype=np.int64)
+    gx = np.sum(np.abs(img[1:] - img[:-1]), axis=-1)
+    gy = np.sum(np.abs(img[:, 1:] - img[:, :-1]), axis=-1)
+    ex = np.zeros((gx.shape[0], gx.shape[1] + 1), dtype=np.int64)
+    np.cumsum(gx, axis=1, out=ex[:, 1:])
+    ey = np.zeros((gy.shape[0] + 1, gy.shape[1]), dtype=np.int64)
+    np.cumsum(gy, axis=0, out=ey[1:])
+    return ex, ey
+
+# Up to n cut positions strictly inside lo..hi, strongest edges first, with
+# the midpoint as a fallback for flat regions.
+def cut_positions(strength, lo, hi, n):
+    if hi - lo < 2:
+        return []
+    best = lo + 1 + np.argsort(-strength, kind='stable')[:n]
+    pos = [int(p) for p in best if strength[p - lo - 1] > 0]
+    mid = (lo + hi) // 2
+    if mid not in pos:
+        pos.append(mid)
+    return pos
+
+def mean_color(rect):
+    return paint.color_tuple(np.clip(np.around(STATS.mean(rect)), 0, 255).astype(int))
+
+# Colors for the parts of a cut: each part gets its mean color when the
+# estimated similarity saving pays for the color move, else None.
+def part_colors(state, rects):
+    colors = []
+    for x0, y0, x1, y1 in rects:
+        current = paint.ALPHA * np.sum(state.dist[x0:x1, y0:y1])
+        cost = sim.compute_cost(sim.COLOR_COST, (x1 - x0) * (y1 - y0), state.width, state.height)
+        if current - STATS.est_cost((x0, y0, x1, y1)) > cost:
+            colors.append(mean_color((x0, y0, x1, y1)))
+        else:
+            colors.append(None)
+    return colors
+
+# Actions are plain tuples, so they are cheap to send between processes:
+#   ('color', name, color)
+#   ('cut', name, orientation, pos, part colors)
+#   ('point', name, (x, y), part colors)
+def action_moves(action):
+    if action[0] == 'color':
+        return [lang.ColorMove(action[1], action[2])]
+    if action[0] == 'cut':
+        _, name, ori, pos, colors = action
+        moves = [lang.LineCutMove(name, ori, pos)]
+    else:
+        _, name, point, colors = action
+        moves = [lang.PointCutMove(name, point)]
+    moves.extend(lang.ColorMove(f'{name}.{k}', c) for k, c in enumerate(colors) if c is not None)
+    return moves
+
+def propose(state, n_blocks, n_pos):
+    ex, ey = EDGES
+    blocks = state.blocks
+    worst = heapq.nlargest(n_blocks, blocks, key=state.block_diff_cost)
+    actions = []
+    for name in worst:
+        b = blocks[name]
+        x0, y0, x1, y1 = b.x, b.y, b.x + b.w, b.y + b.h
+        actions.append(('color', name, mean_color((x0, y0, x1, y1))))
+        xs = cut_positions(ex[x0:x1-1, y1] - ex[x0:x1-1, y0], x0, x1, n_pos)
+        ys = cut_positions(ey[x1, y0:y1-1] - ey[x0, y0:y1-1], y0, y1, n_pos)
+        for x in xs:
+            actions.append(('cut', name, 'x', x, tuple(part_colors(
+                state, [(x0, y0, x, y1), (x, y0, x1, y1)]))))
+        for y in ys:
+            actions.append(('cut', name, 'y', y, tuple(part_colors(
+                state, [(x0, y0, x1, y), (x0, y, x1, y1)]))))
+        for x in xs[:2]:
+            for y in ys[:2]:
+                actions.append(('point', name, (x, y), tuple(part_colors(
+                    state, [(x0, y0, x, y), (x, y0, x1, y), (x, y, x1, y1), (x0, y, x, y1)]))))
+    return actions
+
+# Simulator state of the node at the end of `chain`, the (id, action) path
+# from the root, forked from the deepest node this process still has.
+def node_state(chain):
+    global REPLAYED
+    i = len(chain)
+    while i > 0 and chain[i-1][0] not in STATES:
+        i -= 1
+    base = STATES[chain[i-1][0]] if i > 0 else STATES[0]
+    # the target image is shared between forks
+    state = copy.deepcopy(base, {id(base.ref): base.ref})
+    REPLAYED += len(chain) - i
+    for _, action in chain[i:]:
+        for move in action_moves(action):
+            state.apply(move)
+    if chain:
+        STATES[chain[-1][0]] = state
+    return state
+
+# Scores every proposed action on the node at the end of `chain`, returning
+# the `width` best as (total cost, action). Node states outside `keep`, the
+# nodes being expanded and their parents, are dropped first; a node usually
+# forks from its parent, which the previous step left in its process.
+def expand(chain, keep, width, n_blocks, n_pos):
+    for nid in list(STATES):
+        if nid != 0 and nid not in keep:
+            del STATES[nid]
+    state = node_state(chain)
+    scored = []
+    for action in propose(state, n_blocks, n_pos):
+        cp = state.checkpoint()
+        try:
+            for move in action_moves(action):
+                state.apply(move)
+            scored.append((state.cost + state.sim_cost, action))
+        except sim.ExecutionError:
+            pass
+        finally:
+            state.rollback(cp)
+            state.release(cp)
+    return heapq.nsmallest(width, scored, key=lambda s: s[0])
+
+class BeamPlanner:
+    def __init__(self, fname, *, width=4, n_blocks=4, n_pos=3, jobs=1):
+        self.fname = fname
+        self.width = width
+        self.n_blocks = n_blocks
+        self.n_pos = n_pos
+        self.jobs = jobs
+        # node id -> (parent id, action); 0 is the blank canvas
+        self.nodes = {0: (None, None)}
+
+    def chain(self, nid):
+        out = []
+        while nid != 0:
+            parent, action = self.nodes[nid]
+            out.append((nid, action))
+            nid = parent
+        return out[::-1]
+
+    def moves(self, nid):
+        return [m for _, action in self.chain(nid) for m in action_moves(action)]
+
+    # Best (total cost, node id) found within `budget` seconds, stopping
+    # early once `patience` steps in a row bring no improvement.
+    def search(self, budget, *, patience=20, verbose=False):
+        start = time.time()
+        if self.jobs > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.jobs, initializer=init_worker, initargs=(self.fname,))
+            run = pool.map
+        else:
+            pool = None
+            init_worker(self.fname)
+            run = map
+        try:
+            root = sim.blank_state(ref=paint.load_mapped(self.fname))
+            best = (root.cost + root.sim_cost, 0)
+            beam = [best]
+            stale = 0
+            step = 0
+            while beam and time.time() - start < budget and stale < patience:
+                ids = [nid for _, nid in beam]
+                keep = set(ids) | {self.nodes[nid][0] for nid in ids}
+                results = run(expand, [self.chain(nid) for nid in ids], [keep] * len(ids),
+                              [self.width] * len(ids), [self.n_blocks] * len(ids),
+                              [self.n_pos] * len(ids))
+                children = [(score, parent, action) for parent, res in zip(ids, results)
+                            for score, action in res]
+                beam = []
+                for score, parent, action in heapq.nsmallest(
+                        self.width, children, key=lambda c: c[0]):
+                    nid = len(self.nodes)
+                    self.nodes[nid] = (parent, action)
+                    beam.append((score, nid))
+                step += 1
+                if beam and beam[0][0] < best[0]:
+                    best = beam[0]
+                    stale = 0
+                else:
+                    stale += 1
+                if verbose:
+                    paint.eprint(f'step {step}: {time.time()-start:.1f}s, beam '
+                                 f'{beam[0][0] if beam else float("nan"):.0f}, best {best[0]:.0f}')
+            return best
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True)
+    parser.add_argument('-o', '--output', type=str, required=True)
+    parser.add_argument('-t', '--budget', type=float, default=60,
+                        help='seconds to search for')
+    parser.add_argument('-w', '--width', type=int, default=8,
+                        help='partial programs kept per step')
+    parser.add_argument('--blocks', type=int, default=8,
+                        help='highest cost blocks to try actions on per program')
+    parser.add_argument('--positions', type=int, default=5,
+                        help='edge aligned cut positions to try per block and axis')
+    parser.add_argument('--patience', type=int, default=20,
+                        help='stop after this many steps without improvement')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    img = paint.load_mapped(args.input)
+    planner = BeamPlanner(args.input, width=args.width, n_blocks=args.blocks,
+                          n_pos=args.positions, jobs=args.jobs)
+    estimate, nid = planner.search(args.budget, patience=args.patience, verbose=True)
+
+    with open(args.output, "w") as f:
+        moves = lang.write_moves(f, planner.moves(nid))
+        res = sim.run_program(sim.blank_state(), moves)
+    print(f'Search cost: {estimate:.0f}')
+    print(f'Total cost: {res["cost"] + round(paint.diff_cost(img, res["output"]))}')
+
+if __name__ == '__main__':
+    main()
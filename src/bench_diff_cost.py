@@ -0,0 +1,33 @@
+# Micro-benchmark of paint.diff_cost against the int64 reference implementation
+# on a problem image, opaque and with alpha.
+import argparse
+import numpy as np
+import time
+
+import paint
+
+def bench(f, a, b, reps):
+    start = time.perf_counter()
+    for _ in range(reps):
+        res = f(a, b)
+    return res, (time.perf_counter() - start) / reps
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, default='../problems/1.png')
+    parser.add_argument('-n', '--reps', type=int, default=50)
+    args = parser.parse_args()
+
+    img = paint.load(args.input)
+    rng = np.random.default_rng(0)
+    noisy = rng.integers(0, 256, img.shape, dtype=np.uint8)
+    white = np.full(img.shape, 255, dtype=np.uint8)
+    for name, a, b in [('opaque', img, white), ('alpha', img, noisy)]:
+        fast, t_fast = bench(paint.diff_cost, a, b, args.reps)
+        ref, t_ref = bench(paint.diff_cost_naive, a, b, args.reps)
+        assert abs(fast - ref) <= 1e-9 * ref, (fast, ref)
+        print(f'{name:>6}: diff_cost {t_fast*1e3:.2f}ms, '
+              f'diff_cost_naive {t_ref*1e3:.2f}ms ({t_ref/t_fast:.1f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# Per-trial scoring time of a cheap_grid config (as sweep.score_config does
+# it) fed to the simulator as lang moves straight from paint, against the old
+# route through ISL text and lang.iter_program. Also times producing the moves
+# alone, which is where the difference comes from.
+import argparse
+import time
+
+import lang
+import paint
+import sim
+
+def score(img, moves):
+    res = sim.run_program(sim.blank_state(), moves)
+    return res['cost'] + round(paint.diff_cost(img, res['output']))
+
+def bench(f, reps):
+    start = time.perf_counter()
+    for _ in range(reps):
+        res = f()
+    return res, (time.perf_counter() - start) / reps
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, default='../problems/1.png')
+    parser.add_argument('-n', '--reps', type=int, default=5)
+    args = parser.parse_args()
+
+    img = paint.load_mapped(args.input)
+    for n in [8, 20, 40]:
+        color_blocks, _, _ = paint.grid_colors(img, n)
+        for orient in paint.GRID_ORIENTS[::2]:
+            moves = lambda: paint.grid_moves(img.shape, color_blocks, orient, (0, 0))
+            text = lambda: lang.iter_program(map(lang.format_move, moves()))
+            direct, t_direct = bench(lambda: score(img, moves()), args.reps)
+            parsed, t_parsed = bench(lambda: score(img, text()), args.reps)
+            assert direct == parsed, (direct, parsed)
+            _, t_gen = bench(lambda: sum(1 for _ in moves()), args.reps)
+            _, t_parse = bench(lambda: sum(1 for _ in text()), args.reps)
+            print(f'{n:>3} {orient:>6}: trial {t_direct*1e3:.1f}ms with moves, '
+                  f'{t_parsed*1e3:.1f}ms with text, saved {(t_parsed-t_direct)*1e3:.1f}ms; '
+                  f'generating {t_gen*1e3:.1f}ms vs {t_parse*1e3:.1f}ms ({t_parse/t_gen:.1f}x)')
+
+if __name__ == '__main__':
+    main()
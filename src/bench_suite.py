@@ -0,0 +1,170 @@
+# Benchmark suite: times parsing, simulating, rendering and diffing every
+# progs/*.isl against its problem, and end-to-end paint.solve plus scoring for
+# a fixed set of grid configs on every problem, recording the scores too.
+# Results are saved as JSON and can be compared against a baseline run, in
+# which case slowdowns or score regressions beyond the tolerances exit 1.
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import sys
+import time
+
+import numpy as np
+
+import lang
+import paint
+import problems as problem_set
+import sim
+
+# (num_blocks, orient, (bleed_a, bleed_b)) run through paint.solve per problem
+SOLVE_CONFIGS = [
+    (10, 'vertA', (0, 0)),
+    (20, 'horizB', (2, 2)),
+    (25, 'vertB', (1, 3)),
+    (40, 'horizA', (0, 1)),
+]
+
+# timings below this many seconds are too noisy to call regressions
+MIN_TIME = 0.005
+
+def problem_id(fname):
+    m = re.match(r'(\d+)', os.path.basename(fname))
+    return m.group(1) if m else None
+
+# Best of `reps` wall-clock times of f(), with its last result.
+def timed(f, reps):
+    best = float('inf')
+    for _ in range(reps):
+        start = time.perf_counter()
+        res = f()
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+def bench_prog(fname, img, reps, backend):
+    def parse():
+        with open(fname) as f:
+            return list(lang.iter_program(f))
+    t_parse, moves = timed(parse, reps)
+    t_sim, res = timed(lambda: sim.run_program(
+        sim.blank_state(backend=backend), moves, render=False), reps)
+    t_render, output = timed(res['state'].render, reps)
+    out = {'moves': len(moves), 'parse': t_parse, 'simulate': t_sim,
+           'render': t_render, 'cost': res['cost']}
+    if img is not None:
+        out['diff'], diff_cost = timed(lambda: paint.diff_cost(img, output), reps)
+        out['score'] = res['cost'] + round(diff_cost)
+    return out
+
+def bench_solve(img, config, reps, backend):
+    n, orient, bleed = config
+    def solve():
+        paint.NBLOCKS = n
+        res = sim.run_program(sim.blank_state(backend=backend),
+                              paint.solve_moves(img, orient, bleed))
+        return res['cost'] + round(paint.diff_cost(img, res['output']))
+    t, score = timed(solve, reps)
+    return {'time': t, 'score': score}
+
+def run(problems, progs, *, reps, backend, verbose=True):
+    # cached colors would make the solve timings measure the cache
+    paint.COLOR_CACHE = None
+    imgs = {problem_id(f): paint.load_mapped(f) for f in problems}
+    results = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'backend': backend,
+            'reps': reps,
+        },
+        'progs': {},
+        'solve': {},
+    }
+    for fname in progs:
+        key = os.path.basename(fname)
+        results['progs'][key] = r = bench_prog(fname, imgs.get(problem_id(fname)), reps, backend)
+        if verbose:
+            print(f'{key:>20}: parse {r["parse"]*1e3:7.1f}ms, simulate {r["simulate"]*1e3:7.1f}ms, '
+                  f'render {r["render"]*1e3:6.1f}ms, diff {r.get("diff", 0)*1e3:6.1f}ms, '
+                  f'score {r.get("score")}')
+    for pid, img in imgs.items():
+        for config in SOLVE_CONFIGS:
+            n, orient, bleed = config
+            key = f'{pid}:{n}:{orient}:{bleed[0]},{bleed[1]}'
+            results['solve'][key] = r = bench_solve(img, config, reps, backend)
+            if verbose:
+                print(f'{key:>20}: solve {r["time"]*1e3:7.1f}ms, score {r["score"]}')
+    return results
+
+# (section, key, field, baseline, new) for every slowdown beyond time_tol
+# (relative) and every score increase beyond score_tol (absolute).
+def regressions(base, new, *, time_tol, score_tol):
+    out = []
+    for section in ('progs', 'solve'):
+        for key, b in base.get(section, {}).items():
+            n = new.get(section, {}).get(key)
+            if n is None:
+                continue
+            for field in ('parse', 'simulate', 'render', 'diff', 'time'):
+                if field in b and field in n and n[field] > MIN_TIME and \
+                   n[field] > b[field] * (1 + time_tol):
+                    out.append((section, key, field, b[field], n[field]))
+            for field in ('score', 'cost'):
+                if field in b and field in n and n[field] > b[field] + score_tol:
+                    out.append((section, key, field, b[field], n[field]))
+    return out
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--problems', type=str, nargs='*', default=None,
+                        help='problem PNGs (default: every PNG in the repo\'s problems/)')
+    parser.add_argument('--progs', type=str, nargs='*', default=None,
+                        help='ISL programs (default: every .isl in the repo\'s progs/)')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='write the results here as JSON')
+    parser.add_argument('-b', '--baseline', type=str, default=None,
+                        help='results JSON of an earlier run to compare against')
+    parser.add_argument('-n', '--reps', type=int, default=3,
+                        help='runs per measurement, the fastest counts')
+    parser.add_argument('--backend', type=str, default='canvas', choices=sim.BACKENDS.keys())
+    parser.add_argument('--time_tol', type=float, default=0.25,
+                        help='allowed relative slowdown before failing')
+    parser.add_argument('--score_tol', type=int, default=0,
+                        help='allowed score increase before failing')
+    args = parser.parse_args()
+
+    problems = args.problems
+    if problems is None:
+        problems = problem_set.all_problems()
+        if not problems:
+            parser.error(f'no problem PNGs in {problem_set.PROBLEMS_DIR}')
+    progs = args.progs
+    if progs is None:
+        progs = glob.glob(os.path.join(problem_set.PROGS_DIR, '*.isl'))
+        if not progs:
+            parser.error(f'no programs in {problem_set.PROGS_DIR}')
+    order = lambda f: (int(problem_id(f) or 0), f)
+    start = time.time()
+    results = run(sorted(problems, key=order), sorted(progs, key=order),
+                  reps=args.reps, backend=args.backend)
+    print(f'Benchmarked in {time.time()-start:.2f}s')
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            base = json.load(f)
+        bad = regressions(base, results, time_tol=args.time_tol, score_tol=args.score_tol)
+        for section, key, field, b, n in bad:
+            print(f'REGRESSION {section} {key} {field}: {b:.4g} -> {n:.4g}')
+        if bad:
+            print(f'{len(bad)} regressions against {args.baseline}')
+            sys.exit(1)
+        print(f'No regressions against {args.baseline}')
+
+if __name__ == '__main__':
+    main()
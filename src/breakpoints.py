@@ -0,0 +1,225 @@
+# Picks row and column breakpoints for paint.breakpoint_grid by alternating
+# 1D dynamic programs: columns given the rows, then rows given the columns.
+# Execution costs are exact compute_cost prices of the raster's moves (bleed
+# 0), similarity is estimated from regions.RegionStats. Every orientation is
+# planned as vertA over a flipped/transposed image.
+import argparse
+import numpy as np
+import time
+
+import lang
+import paint
+import regions
+import sim
+
+# The image as seen by the vertA raster for orientation `ori`, and a function
+# mapping breakpoints found on it back to (xs, ys) of the original image.
+def oriented(img, ori):
+    W, H = img.shape[:2]
+    flip = lambda b, n: n - b[::-1]
+    if ori == 'vertA':
+        return img, lambda xs, ys: (xs, ys)
+    if ori == 'vertB':
+        return img[:, ::-1], lambda xs, ys: (xs, flip(ys, H))
+    if ori == 'horizA':
+        return img.swapaxes(0, 1), lambda xs, ys: (ys, xs)
+    assert ori == 'horizB'
+    return img.swapaxes(0, 1)[:, ::-1], lambda xs, ys: (flip(ys, W), xs)
+
+# `scale` multiplies the similarity estimates, for images that stand in for a
+# larger one (paint.pyramid levels): it is the number of target pixels per
+# pixel of img.
+class BreakpointOptimizer:
+    def __init__(self, img, *, step, scale=1):
+        self.stats = regions.RegionStats(img)
+        self.scale = scale
+        self.W, self.H = img.shape[:2]
+        self.px = np.array(sorted(set(range(0, self.W, step)) | {self.W}))
+        self.py = np.array(sorted(set(range(0, self.H, step)) | {self.H}))
+
+    # Similarity estimates of the cells xs[i]..xs[i+1] x ys[j]..ys[j+1], over
+    # any (broadcast) arrays of cell edges.
+    def cell_costs(self, x0, y0, x1, y1):
+        rects = np.stack(np.broadcast_arrays(x0, y0, x1, y1), axis=-1)
+        # empty and inverted cells come out nan and are masked by the callers
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.scale * self.stats.est_cost(rects)
+
+    # Execution cost of every move in the raster, raster cost model for vertA:
+    # band j starts on the block ys[j]..H, gets colored, then every column
+    # breakpoint costs a cut, a color of the right part and a merge, and
+    # every band but the last ends in a y cut.
+    def band_exec(self, xs, y0, last):
+        S = self.W * self.H
+        h = self.H - np.asarray(y0)[..., None]
+        xb = np.asarray(xs[1:-1])
+        cost = sim.compute_costs(sim.COLOR_COST, self.W * h[..., 0], S)
+        cost = cost + np.sum(sim.compute_costs(sim.LINE_CUT_COST, self.W * h, S) +
+                             sim.compute_costs(sim.COLOR_COST, (self.W - xb) * h, S) +
+                             sim.compute_costs(sim.MERGE_COST, np.maximum(xb, self.W - xb) * h, S),
+                             axis=-1)
+        return cost + np.where(last, 0, sim.compute_costs(sim.LINE_CUT_COST, self.W * h[..., 0], S))
+
+    def col_exec(self, x, ys):
+        S = self.W * self.H
+        h = self.H - np.asarray(ys[:-1])
+        x = np.asarray(x)[..., None]
+        return np.sum(sim.compute_costs(sim.LINE_CUT_COST, self.W * h, S) +
+                      sim.compute_costs(sim.COLOR_COST, (self.W - x) * h, S) +
+                      sim.compute_costs(sim.MERGE_COST, np.maximum(x, self.W - x) * h, S), axis=-1)
+
+    # Best breakpoints among `pts` given segment costs seg[a, b] (pts[a] to
+    # pts[b]), by a 1D shortest path from the first to the last point.
+    @staticmethod
+    def best_path(pts, seg):
+        P = len(pts)
+        F = np.full(P, np.inf)
+        F[0] = 0
+        prev = np.zeros(P, dtype=int)
+        for b in range(1, P):
+            cand = F[:b] + seg[:b, b]
+            prev[b] = np.argmin(cand)
+            F[b] = cand[prev[b]]
+        path = [P - 1]
+        while path[-1] != 0:
+            path.append(prev[path[-1]])
+        return pts[path[::-1]], F[-1]
+
+    def best_cols(self, ys):
+        a = self.px[:, None, None]
+        b = self.px[None, :, None]
+        seg = np.sum(self.cell_costs(a, ys[None, None, :-1], b, ys[None, None, 1:]), axis=-1)
+        seg = seg + np.where(self.px > 0, self.col_exec(self.px, ys), 0)[:, None]
+        seg[self.px[:, None] >= self.px[None, :]] = np.inf
+        return self.best_path(self.px, seg)
+
+    def best_rows(self, xs):
+        a = self.py[:, None, None]
+        b = self.py[None, :, None]
+        seg = np.sum(self.cell_costs(xs[None, None, :-1], a, xs[None, None, 1:], b), axis=-1)
+        seg = seg + self.band_exec(xs, self.py[:, None], self.py[None, :] == self.H)
+        seg[self.py[:, None] >= self.py[None, :]] = np.inf
+        return self.best_path(self.py, seg)
+
+    # Alternates column and row DPs from an n_init x n_init uniform grid until
+    # the estimate stops improving. Returns (xs, ys, estimated cost).
+    def optimize(self, *, n_init=8, max_rounds=10, verbose=False):
+        ys = np.linspace(0, self.H, n_init + 1).astype(int)
+        best = (None, None, np.inf)
+        for r in range(max_rounds):
+            xs, _ = self.best_cols(ys)
+            ys, cost = self.best_rows(xs)
+            if verbose:
+                paint.eprint(f'round {r}: {len(xs)-1} x {len(ys)-1} cells, estimate {cost:.0f}')
+            if cost >= best[2]:
+                break
+            best = (xs, ys, cost)
+        return best
+
+    # Estimated cost of the raster over breakpoints xs, ys.
+    def estimate(self, xs, ys):
+        cells = self.cell_costs(xs[:-1, None], ys[None, :-1], xs[1:, None], ys[None, 1:])
+        return np.sum(cells) + np.sum(self.band_exec(xs, ys[:-1], ys[1:] == self.H))
+
+    # Coordinate descent: moves each breakpoint in turn to its best spot
+    # within `radius` of where it is, re-costing only the cells on either
+    # side of it and the moves whose price depends on it, until a pass moves
+    # nothing. Returns (xs, ys, estimated cost).
+    def refine(self, xs, ys, *, radius=1, max_passes=4):
+        xs, ys = np.array(xs), np.array(ys)
+        d = np.arange(-radius, radius + 1)
+        for _ in range(max_passes):
+            moved = False
+            for i in range(1, len(xs) - 1):
+                c = xs[i] + d
+                c = c[(c > xs[i-1]) & (c < xs[i+1])]
+                cost = np.sum(self.cell_costs(xs[i-1], ys[:-1], c[:, None], ys[1:]) +
+                              self.cell_costs(c[:, None], ys[:-1], xs[i+1], ys[1:]), axis=-1)
+                best = c[np.argmin(cost + self.col_exec(c, ys))]
+                moved |= best != xs[i]
+                xs[i] = best
+            for j in range(1, len(ys) - 1):
+                c = ys[j] + d
+                c = c[(c > ys[j-1]) & (c < ys[j+1])]
+                # only band j starts at ys[j]; band j-1's moves do not move
+                cost = np.sum(self.cell_costs(xs[:-1], ys[j-1], xs[1:], c[:, None]) +
+                              self.cell_costs(xs[:-1], c[:, None], xs[1:], ys[j+1]), axis=-1)
+                best = c[np.argmin(cost + self.band_exec(xs, c, ys[j+1] == self.H))]
+                moved |= best != ys[j]
+                ys[j] = best
+            if not moved:
+                break
+        return xs, ys, self.estimate(xs, ys)
+
+# Best (estimate, orientation, xs, ys) over all orientations.
+def optimize(img, *, step, n_init=8, max_rounds=10, verbose=False):
+    best = None
+    for ori in paint.GRID_ORIENTS:
+        view, unmap = oriented(img, ori)
+        xs, ys, cost = BreakpointOptimizer(view, step=step).optimize(
+            n_init=n_init, max_rounds=max_rounds)
+        if verbose:
+            paint.eprint(f'{ori}: {len(xs)-1} x {len(ys)-1} cells, estimate {cost:.0f}')
+        if best is None or cost < best[0]:
+            best = (cost, ori) + unmap(xs, ys)
+    return best
+
+# optimize on the coarsest of `levels` halvings of img (paint.pyramid), with
+# `step` in coarse pixels, then doubled and refined level by level back up
+# to full resolution.
+def optimize_pyramid(img, *, levels, step=1, n_init=8, max_rounds=10, radius=1, verbose=False):
+    pyr = paint.pyramid(img, levels)
+    best = None
+    for ori in paint.GRID_ORIENTS:
+        start = time.time()
+        view, _ = oriented(pyr[-1], ori)
+        xs, ys, cost = BreakpointOptimizer(view, step=step, scale=4**levels).optimize(
+            n_init=n_init, max_rounds=max_rounds)
+        for level in range(levels - 1, -1, -1):
+            view, unmap = oriented(pyr[level], ori)
+            xs, ys, cost = BreakpointOptimizer(view, step=1, scale=4**level).refine(
+                2 * xs, 2 * ys, radius=radius)
+        if verbose:
+            paint.eprint(f'{ori}: {len(xs)-1} x {len(ys)-1} cells, estimate {cost:.0f} '
+                         f'({time.time()-start:.2f}s)')
+        if best is None or cost < best[0]:
+            best = (cost, ori) + unmap(xs, ys)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True)
+    parser.add_argument('-o', '--output', type=str, required=True)
+    parser.add_argument('--step', type=int, default=4,
+                        help='spacing of candidate breakpoints')
+    parser.add_argument('--n_init', type=int, default=8,
+                        help='uniform rows to start the alternation from')
+    parser.add_argument('--max_rounds', type=int, default=10)
+    parser.add_argument('--levels', type=int, default=0,
+                        help='solve this many halvings down and refine back up (step is then '
+                             'in coarse pixels)')
+    args = parser.parse_args()
+
+    img = paint.load_mapped(args.input)
+    if args.levels > paint.max_pyramid_levels(img.shape):
+        parser.error(f'--levels {args.levels} is too deep for a {img.shape[0]}x{img.shape[1]} '
+                     f'image, at most {paint.max_pyramid_levels(img.shape)}')
+    start = time.time()
+    if args.levels > 0:
+        estimate, ori, xs, ys = optimize_pyramid(
+            img, levels=args.levels, step=args.step, n_init=args.n_init,
+            max_rounds=args.max_rounds, verbose=True)
+    else:
+        estimate, ori, xs, ys = optimize(img, step=args.step, n_init=args.n_init,
+                                         max_rounds=args.max_rounds, verbose=True)
+    print(f'Optimized in {time.time()-start:.2f}s')
+
+    with open(args.output, "w") as f:
+        moves = lang.write_moves(f, paint.solve_breaks_moves(img, xs, ys, ori))
+        res = sim.run_program(sim.blank_state(), moves)
+    print(f'Best config: {{"orient": {ori!r}, "xs": {xs.tolist()}, "ys": {ys.tolist()}}}')
+    print(f'Estimated cost: {estimate:.0f}')
+    print(f'Total cost: {res["cost"] + round(paint.diff_cost(img, res["output"]))}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+### On-disk LRU cache of solved grid colors. Each entry is a directory of .npy
+### files that are memory-mapped back in on a hit.
+
+import argparse
+import hashlib
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+DEFAULT_DIR = os.environ.get(
+    'PAINT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'paint-colors'))
+DEFAULT_MAX_BYTES = 256 << 20
+
+# bump when the color solver changes in a way that changes its answers
+VERSION = 1
+
+def image_hash(img):
+    h = hashlib.sha1()
+    h.update(f'{img.shape} {img.dtype.str}'.encode())
+    h.update(np.ascontiguousarray(img).data)
+    return h.hexdigest()
+
+def grid_key(img, grid, tol):
+    return f'{image_hash(img)}-{grid[0]}x{grid[1]}-tol{tol:g}-v{VERSION}'
+
+class ColorCache:
+    def __init__(self, path=DEFAULT_DIR, *, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def entry(self, key):
+        return os.path.join(self.path, key)
+
+    # Memory-mapped arrays stored under `key`, in the order of `names`, or None.
+    def get(self, key, names):
+        d = self.entry(key)
+        try:
+            arrs = tuple(np.load(os.path.join(d, f'{name}.npy'), mmap_mode='r')
+                         for name in names)
+            os.utime(d)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return arrs
+
+    # Writes into a private directory and renames it into place, so concurrent
+    # writers of the same key (e.g. sweep workers) never see a partial entry.
+    def put(self, key, **arrays):
+        os.makedirs(self.path, exist_ok=True)
+        tmp = self.entry(f'.tmp-{uuid.uuid4().hex}')
+        os.mkdir(tmp)
+        for name, arr in arrays.items():
+            np.save(os.path.join(tmp, f'{name}.npy'), arr)
+        try:
+            os.rename(tmp, self.entry(key))
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=key)
+
+    def entries(self):
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        res = []
+        for name in names:
+            if name.startswith('.'):
+                continue
+            d = self.entry(name)
+            try:
+                nbytes = sum(e.stat().st_size for e in os.scandir(d))
+                res.append((os.stat(d).st_mtime, nbytes, name))
+            except FileNotFoundError:
+                pass
+        return res
+
+    # Drops least recently used entries until the cache fits in max_bytes.
+    def evict(self, *, keep=None):
+        entries = sorted(self.entries())
+        total = sum(e[1] for e in entries)
+        for _, nbytes, name in entries:
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(self.entry(name), ignore_errors=True)
+            total -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        for _, _, name in self.entries():
+            shutil.rmtree(self.entry(name), ignore_errors=True)
+
+    def stats(self):
+        entries = self.entries()
+        return (f'color cache {self.path}: {self.hits} hits, {self.misses} misses, '
+                f'{self.evictions} evictions, {len(entries)} entries, '
+                f'{sum(e[1] for e in entries) / 2**20:.1f} MiB')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', type=str, default=DEFAULT_DIR)
+    parser.add_argument('--clear', action='store_true', help='remove every entry')
+    args = parser.parse_args()
+    cache = ColorCache(args.dir)
+    if args.clear:
+        cache.clear()
+    print(cache.stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,6 @@
+### Constants of the contest scoring, shared by every module that costs images.
+
+# channels per pixel (RGBA)
+NCHAN = 4
+# weight of the summed per-pixel color distance in the similarity cost
+ALPHA = 0.005
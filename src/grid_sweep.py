@@ -0,0 +1,66 @@
+# Exhaustive search over cheap_grid configs (grid size, orientation, bleeds)
+# using the exact cost model in paint, checked against the simulator at the end.
+import argparse
+import math
+import numpy as np
+import time
+
+import lang
+import paint
+import regions
+import sim
+
+def divisors(n):
+    return [d for d in range(1, n+1) if n % d == 0]
+
+# Best (cost, n_blocks, orient, (bleed_A, bleed_B)) over every grid size that
+# divides the image, every orientation and every bleed pair up to max_bleed.
+def sweep(img, *, max_bleed, verbose=False):
+    best = None
+    stats = regions.RegionStats(img)
+    for n in divisors(math.gcd(img.shape[0], img.shape[1])):
+        start = time.time()
+        color_blocks, cells, _ = paint.grid_colors(img, n, stats=stats)
+        for orient in paint.GRID_ORIENTS:
+            exec_costs = paint.grid_exec_costs(img.shape, n, orient, max_bleed)
+            sim_costs = paint.grid_sim_costs(color_blocks, cells, orient, max_bleed)
+            total = exec_costs + np.round(sim_costs).astype(np.int64)
+            ba, bb = np.unravel_index(np.argmin(total), total.shape)
+            cand = (int(total[ba,bb]), n, orient, (int(ba), int(bb)))
+            if best is None or cand[0] < best[0]:
+                best = cand
+        if verbose:
+            paint.eprint(f'n_blocks={n}: {time.time()-start:.2f}s, best so far {best}')
+    return best
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True)
+    parser.add_argument('-o', '--output', type=str, required=True)
+    parser.add_argument('--max_bleed', type=int, default=16,
+                        help='largest bleed (A and B) to consider')
+    parser.add_argument('--no-cache', action='store_true', help='always re-solve grid colors')
+    args = parser.parse_args()
+    if args.no_cache:
+        paint.COLOR_CACHE = None
+
+    img = paint.load_mapped(args.input)
+    start = time.time()
+    cost, n, orient, bleed = sweep(img, max_bleed=args.max_bleed, verbose=True)
+    print(f'Swept in {time.time()-start:.2f}s')
+
+    paint.NBLOCKS = n
+    with open(args.output, "w") as f:
+        moves = lang.write_moves(f, paint.solve_moves(img, orient, bleed))
+        res = sim.run_program(sim.blank_state(), moves)
+    sim_cost = res['cost'] + round(paint.diff_cost(img, res['output']))
+    assert sim_cost == cost, f'model cost {cost} != simulated cost {sim_cost}'
+
+    best_config = {'num_blocks': n, 'orient': orient, 'bleed_a': bleed[0], 'bleed_b': bleed[1]}
+    print(f"Best config: {best_config}")
+    print(f'Total cost: {cost} (matches simulator)')
+    if paint.COLOR_CACHE is not None:
+        paint.eprint(paint.COLOR_CACHE.stats())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# Guillotine planner: dynamic programming over recursive line/point cut trees
+# whose cuts lie on a coarse candidate grid. Leaves are either painted (color
+# move plus the similarity of the region's color) or left as the white
+# background, with similarity estimated in O(1) from regions.RegionStats.
+import argparse
+import concurrent.futures
+import numpy as np
+import os
+import time
+from multiprocessing import shared_memory
+
+import lang
+import paint
+import regions
+import sim
+
+BACKGROUND = np.array([255, 255, 255, 255])
+
+# choices for a rectangle at some depth
+LEAF_PAINT = 0
+LEAF_KEEP = 1
+CUT_X = 2
+CUT_Y = 3
+CUT_POINT = 4
+
+# per process DP state: candidate coordinates, region stats and the previous
+# (deeper) level's best costs, L[i0, i1, j0, j1] for rectangle
+# xs[i0]..xs[i1] x ys[j0]..ys[j1]
+XS = None
+YS = None
+STATS = None
+L = None
+SHM = None
+LEAF = {}
+
+def init_worker(xs, ys, stats, shm_name):
+    global XS, YS, STATS, L, SHM
+    XS = xs
+    YS = ys
+    LEAF.clear()
+    STATS = stats
+    if shm_name is not None:
+        SHM = shared_memory.SharedMemory(name=shm_name)
+        L = np.ndarray((len(xs),) * 2 + (len(ys),) * 2, dtype=np.float64, buffer=SHM.buf)
+
+# sim.compute_costs on the planned canvas, inf for empty rectangles
+def move_costs(base, area):
+    return sim.compute_costs(base, area, (XS[-1] - XS[0]) * (YS[-1] - YS[0]))
+
+# Leaf costs and cut prices of every rectangle starting at row i0, indexed
+# [i1, j0, j1].
+def leaf_costs(i0):
+    if i0 not in LEAF:
+        x0 = XS[i0]
+        x1 = XS[:, None, None]
+        y0 = YS[None, :, None]
+        y1 = YS[None, None, :]
+        shape = (len(XS), len(YS), len(YS))
+        rects = np.stack(np.broadcast_arrays(
+            np.full(shape, x0), y0, np.maximum(x1, x0), np.maximum(y1, y0)), axis=-1)
+        area = (rects[..., 2] - rects[..., 0]) * (rects[..., 3] - rects[..., 1])
+        valid = area > 0
+        rects[~valid] = (0, 0, 1, 1)
+        n = area.astype(np.float64)
+        mean = STATS.mean(rects)
+        sse = STATS.sse(rects)
+        paint_cost = move_costs(sim.COLOR_COST, area) + STATS.est_cost(rects)
+        bg_sse = sse + n * np.sum((mean - BACKGROUND)**2, axis=-1)
+        keep_cost = np.where(valid, regions.EST_SCALE * paint.ALPHA * np.sqrt(n * bg_sse), np.inf)
+        LEAF[i0] = (paint_cost, keep_cost,
+                    move_costs(sim.LINE_CUT_COST, area), move_costs(sim.POINT_CUT_COST, area))
+    return LEAF[i0]
+
+# Best cost and choice for every rectangle starting at row i0. L holds the
+# costs one level deeper; at the depth limit (`cuts` false) only leaves count.
+def solve_row(i0, cuts):
+    paint_cost, keep_cost, line_cost, point_cost = leaf_costs(i0)
+    best = np.minimum(paint_cost, keep_cost)
+    kind = np.where(keep_cost < paint_cost, LEAF_KEEP, LEAF_PAINT).astype(np.int8)
+    pos_a = np.zeros(best.shape, dtype=np.int16)
+    pos_b = np.zeros(best.shape, dtype=np.int16)
+    if not cuts:
+        return best, kind, pos_a, pos_b
+    K = len(XS) - 1
+    M = len(YS) - 1
+    Li = L[i0]
+
+    def update(sl, cand, k, a, b):
+        better = cand < best[sl]
+        np.copyto(best[sl], cand, where=better)
+        np.copyto(kind[sl], k, where=better)
+        np.copyto(pos_a[sl], a, where=better)
+        np.copyto(pos_b[sl], b, where=better)
+
+    for m in range(i0 + 1, K):
+        # x cut at xs[m]: left is [i0, m], right is [m, i1]
+        sl = np.s_[m+1:]
+        cand = Li[m][None] + L[m, m+1:] + line_cost[sl]
+        update(sl, cand, CUT_X, m, 0)
+    for q in range(1, M):
+        # y cut at ys[q]: bottom is [j0, q], top is [q, j1]
+        sl = np.s_[:, :q, q+1:]
+        cand = Li[:, :q, q][:, :, None] + Li[:, q, q+1:][:, None, :] + line_cost[sl]
+        update(sl, cand, CUT_Y, q, 0)
+    for m in range(i0 + 1, K):
+        Lm = L[m, m+1:]
+        for q in range(1, M):
+            # children 0..3: bottom-left, bottom-right, top-right, top-left
+            sl = np.s_[m+1:, :q, q+1:]
+            cand = (Li[m, :q, q][None, :, None] + Lm[:, :q, q][:, :, None] +
+                    Lm[:, q, q+1:][:, None, :] + Li[m, q, q+1:][None, None, :] +
+                    point_cost[sl])
+            update(sl, cand, CUT_POINT, m, q)
+    return best, kind, pos_a, pos_b
+
+class Planner:
+    def __init__(self, img, *, step, max_depth, jobs=1, stats=None):
+        self.img = img
+        self.xs = np.array(sorted(set(range(0, img.shape[0], step)) | {img.shape[0]}))
+        self.ys = np.array(sorted(set(range(0, img.shape[1], step)) | {img.shape[1]}))
+        self.max_depth = max_depth
+        self.jobs = jobs
+        self.stats = regions.RegionStats(img) if stats is None else stats
+
+    # Fills self.choices[d] (kind, pos_a, pos_b arrays over [i0, i1, j0, j1])
+    # for every depth, deepest first, and returns the estimated best cost.
+    def plan(self, verbose=False):
+        K1, M1 = len(self.xs), len(self.ys)
+        shape = (K1, K1, M1, M1)
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 8)
+        pool = None
+        try:
+            Lshared = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+            if self.jobs > 1:
+                pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.jobs, initializer=init_worker,
+                    initargs=(self.xs, self.ys, self.stats, shm.name))
+                run = lambda cuts: pool.map(solve_row, range(K1), [cuts] * K1)
+            else:
+                init_worker(self.xs, self.ys, self.stats, shm.name)
+                run = lambda cuts: map(solve_row, range(K1), [cuts] * K1)
+            self.choices = [None] * (self.max_depth + 1)
+            for d in range(self.max_depth, -1, -1):
+                start = time.time()
+                rows = list(run(d < self.max_depth))
+                best = np.stack([r[0] for r in rows])
+                self.choices[d] = tuple(np.stack([r[k] for r in rows]) for k in (1, 2, 3))
+                Lshared[:] = best
+                if verbose:
+                    paint.eprint(f'depth {d}: {time.time()-start:.2f}s, '
+                                 f'estimate {best[0, -1, 0, -1]:.0f}')
+            return float(Lshared[0, -1, 0, -1])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            global L, SHM
+            L = SHM = None
+            LEAF.clear()
+            shm.close()
+            shm.unlink()
+
+    # lang moves for the planned tree. Painted leaves get the exact optimal color of
+    # their pixels rather than the mean the plan was costed with.
+    def emit(self):
+        moves = []
+        stack = [('0', 0, 0, len(self.xs) - 1, 0, len(self.ys) - 1)]
+        while stack:
+            bid, d, i0, i1, j0, j1 = stack.pop()
+            kind, pos_a, pos_b = (c[i0, i1, j0, j1] for c in self.choices[d])
+            x0, x1, y0, y1 = self.xs[i0], self.xs[i1], self.ys[j0], self.ys[j1]
+            if kind == LEAF_PAINT:
+                color, _ = paint.optimize_color(self.img[x0:x1, y0:y1])
+                color = np.clip(np.around(color).astype(int), 0, 255)
+                moves.append(lang.ColorMove(bid, paint.color_tuple(color)))
+            elif kind == CUT_X:
+                moves.append(lang.LineCutMove(bid, 'x', int(self.xs[pos_a])))
+                children = [(i0, pos_a, j0, j1), (pos_a, i1, j0, j1)]
+            elif kind == CUT_Y:
+                moves.append(lang.LineCutMove(bid, 'y', int(self.ys[pos_a])))
+                children = [(i0, i1, j0, pos_a), (i0, i1, pos_a, j1)]
+            elif kind == CUT_POINT:
+                moves.append(lang.PointCutMove(bid, (int(self.xs[pos_a]), int(self.ys[pos_b]))))
+                children = [(i0, pos_a, j0, pos_b), (pos_a, i1, j0, pos_b),
+                            (pos_a, i1, pos_b, j1), (i0, pos_a, pos_b, j1)]
+            if kind in (CUT_X, CUT_Y, CUT_POINT):
+                for k, child in reversed(list(enumerate(children))):
+                    stack.append((f'{bid}.{k}', d + 1) + child)
+        return moves
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True)
+    parser.add_argument('-o', '--output', type=str, required=True)
+    parser.add_argument('--step', type=int, default=20,
+                        help='spacing of candidate cut positions')
+    parser.add_argument('--max_depth', type=int, default=6,
+                        help='largest number of nested cuts')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    img = paint.load_mapped(args.input)
+    start = time.time()
+    planner = Planner(img, step=args.step, max_depth=args.max_depth, jobs=args.jobs)
+    estimate = planner.plan(verbose=True)
+    moves = planner.emit()
+    print(f'Planned in {time.time()-start:.2f}s')
+
+    with open(args.output, "w") as f:
+        res = sim.run_program(sim.blank_state(), lang.write_moves(f, moves))
+    print(f'Estimated cost: {estimate:.0f}')
+    print(f'Total cost: {res["cost"] + round(paint.diff_cost(img, res["output"]))}')
+
+if __name__ == '__main__':
+    main()
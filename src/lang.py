@@ -1,42 +1,77 @@
 ### Parser for the ISL.
 
+import argparse
+import io
+import itertools
+import numpy as np
+import os
+
+# Where moves came from. Moves only keep their line number, and the text of a
+# line is looked up here when an error needs it.
+class Source:
+    def __init__(self, *, text=None, lines=None, fname=None, compiled=None):
+        self.text = text
+        self.lines = lines
+        self.fname = fname
+        self.compiled = compiled
+    def line(self, lineno):
+        if self.compiled is not None:
+            ops, names = self.compiled
+            i = np.searchsorted(ops['lineno'], lineno)
+            row, = iter_rows(ops[i:i+1])
+            return format_move(row_to_move(row, names))
+        if self.lines is not None:
+            return self.lines[lineno-1]
+        if self.text is not None:
+            return self.text.split('\n')[lineno-1]
+        if self.fname is not None:
+            with open(self.fname, 'r') as f:
+                line = next(itertools.islice(f, lineno-1, None), '')
+            return line.rstrip('\n')
+        return ''
+
 class Move:
-    meta = None
+    __slots__ = ('lineno', 'src')
+    @property
+    def meta(self):
+        line = self.src.line(self.lineno) if self.src is not None else ''
+        return {'lineno': self.lineno, 'line': line}
 class ColorMove(Move):
-    meta = {'cmd': 'move'}
-    def __init__(self, block, color, *, meta):
+    __slots__ = ('block', 'color')
+    def __init__(self, block, color, *, lineno=None, src=None):
         self.block = block
         self.color = color
-        self.meta['cmd'] = 'move'
-        self.meta |= meta
+        self.lineno = lineno
+        self.src = src
 class SwapMove(Move):
-    meta = {'cmd': 'swap'}
-    def __init__(self, block1, block2, *, meta):
+    __slots__ = ('block1', 'block2')
+    def __init__(self, block1, block2, *, lineno=None, src=None):
         self.block1 = block1
         self.block2 = block2
-        self.meta['cmd'] = 'swap'
-        self.meta |= meta
+        self.lineno = lineno
+        self.src = src
 class MergeMove(Move):
-    meta = {'cmd': 'merge'}
-    def __init__(self, block1, block2, *, meta):
+    __slots__ = ('block1', 'block2')
+    def __init__(self, block1, block2, *, lineno=None, src=None):
         self.block1 = block1
         self.block2 = block2
-        self.meta['cmd'] = 'merge'
-        self.meta |= meta
+        self.lineno = lineno
+        self.src = src
 class LineCutMove(Move):
-    meta = {'cmd': 'cut'}
-    def __init__(self, block, orientation, pos, *, meta):
+    __slots__ = ('block', 'orientation', 'pos')
+    def __init__(self, block, orientation, pos, *, lineno=None, src=None):
         self.block = block
         self.orientation = orientation
         self.pos = pos
-        self.meta['cmd'] = 'cut (line)'
-        self.meta |= meta
+        self.lineno = lineno
+        self.src = src
 class PointCutMove(Move):
-    meta = {'cmd': 'cut'}
-    def __init__(self, block, point, *, meta):
+    __slots__ = ('block', 'point')
+    def __init__(self, block, point, *, lineno=None, src=None):
         self.block = block
         self.point = point
-        self.meta |= meta
+        self.lineno = lineno
+        self.src = src
 
 class ParseError(Exception):
     def __init__(self, msg, meta):
@@ -63,12 +98,16 @@ def parse_block(s, meta):
     return s.strip()
 
 def parse_point(s, meta):
-    x,y = parse_num_list(s, meta)
-    return (x,y)
+    l = parse_num_list(s, meta)
+    if len(l) != 2:
+        raise ParseError(f'Point must be two numbers, got {s}', meta)
+    return tuple(l)
 
 def parse_color(s, meta):
-    r,g,b,a = parse_num_list(s, meta)
-    return (r,g,b,a)
+    l = parse_num_list(s, meta)
+    if len(l) != 4:
+        raise ParseError(f'Color must be four numbers, got {s}', meta)
+    return tuple(l)
 
 def parse_line_pos(s, meta):
     l = parse_num_list(s, meta)
@@ -84,9 +123,11 @@ def parse_orientation(s, meta):
     else:
         raise ParseError('Bad orientation', meta)
 
-def parse_line(line, *, meta):
+def parse_line(line, *, lineno=None, src=None):
     if line.startswith('#'): return None
     if len(line.strip()) == 0: return None
+    meta = {'lineno': lineno, 'line': line}
+    loc = {'lineno': lineno, 'src': src}
 
     # lexing
     head, tail = line.split(' ', 1)
@@ -106,12 +147,12 @@ def parse_line(line, *, meta):
         if len(tokens) == 3:
             block = parse_block(tokens[1], meta)
             point = parse_point(tokens[2], meta)
-            return PointCutMove(block, point, meta=meta)
+            return PointCutMove(block, point, **loc)
         elif len(tokens) == 4:
             block = parse_block(tokens[1], meta)
             orientation = parse_orientation(tokens[2], meta)
             pos = parse_line_pos(tokens[3], meta)
-            return LineCutMove(block, orientation, pos, meta=meta)
+            return LineCutMove(block, orientation, pos, **loc)
         else:
             raise ParseError('Invalid cut command', meta)
     elif tokens[0] == 'color':
@@ -119,32 +160,208 @@ def parse_line(line, *, meta):
             raise ParseError('Invalid color command', meta)
         block = parse_block(tokens[1], meta)
         color = parse_color(tokens[2], meta)
-        return ColorMove(block, color, meta=meta)
+        return ColorMove(block, color, **loc)
     elif tokens[0] == 'swap':
         if len(tokens) != 3:
             raise ParseError('Invalid swap command', meta)
         block1 = parse_block(tokens[1], meta)
         block2 = parse_block(tokens[2], meta)
-        return SwapMove(block1, block2, meta=meta)
+        return SwapMove(block1, block2, **loc)
     elif tokens[0] == 'merge':
         if len(tokens) != 3:
             raise ParseError('Invalid merge command', meta)
         block1 = parse_block(tokens[1], meta)
         block2 = parse_block(tokens[2], meta)
-        return MergeMove(block1, block2, meta=meta)
+        return MergeMove(block1, block2, **loc)
     else:
         raise ParseError('Invalid move.', meta)
 
 
 def parse_lines(lines):
+    # Source.line indexes the lines when an error needs one
+    lines = list(lines)
+    src = Source(lines=lines)
     moves = []
     for i,line in enumerate(lines):
-        meta = {'lineno': i+1, 'line': line}
-        move = parse_line(line, meta=meta)
+        move = parse_line(line, lineno=i+1, src=src)
         if move is not None:
             moves.append(move)
     return moves
 
+# Parses an open program file (or any iterable of lines, such as a command
+# generator) line by line, without holding the program text.
+def iter_program(f, *, src=None):
+    if src is None:
+        fname = getattr(f, 'name', None)
+        if not isinstance(fname, str) or not os.path.isfile(fname):
+            fname = None
+        src = Source(fname=fname)
+    for i,line in enumerate(f):
+        move = parse_line(line.rstrip('\n'), lineno=i+1, src=src)
+        if move is not None:
+            yield move
+
 
 def parse_program(s):
-    return parse_lines(s.split('\n'))
+    return list(iter_program(io.StringIO(s), src=Source(text=s)))
+
+
+def format_move(move):
+    if isinstance(move, ColorMove):
+        r,g,b,a = move.color
+        return f'color [{move.block}] [{r}, {g}, {b}, {a}]'
+    elif isinstance(move, SwapMove):
+        return f'swap [{move.block1}] [{move.block2}]'
+    elif isinstance(move, MergeMove):
+        return f'merge [{move.block1}] [{move.block2}]'
+    elif isinstance(move, LineCutMove):
+        return f'cut [{move.block}] [{move.orientation}] [{move.pos}]'
+    elif isinstance(move, PointCutMove):
+        x,y = move.point
+        return f'cut [{move.block}] [{x}, {y}]'
+    else:
+        raise NotImplementedError()
+
+def format_program(moves):
+    return ''.join(format_move(move) + '\n' for move in moves)
+
+# Passes moves through unchanged, writing each one to f as ISL on the way, so a
+# planner's moves can be simulated and saved in one pass without re-parsing.
+def write_moves(f, moves):
+    for move in moves:
+        f.write(format_move(move) + '\n')
+        yield move
+
+
+### Compiled programs: one row of MOVE_DTYPE per move, with block names
+### interned into a separate names table that b1/b2 index. Saved as .npz.
+
+OP_COLOR = 0
+OP_SWAP = 1
+OP_MERGE = 2
+OP_LINE_CUT_X = 3
+OP_LINE_CUT_Y = 4
+OP_POINT_CUT = 5
+
+# Colors are kept as int32 so out-of-range colors still fail at execution time,
+# like they do when running the text. Numbers that do not fit in int32 at all
+# are a ParseError when compiling.
+MOVE_DTYPE = np.dtype([
+    ('op', np.uint8),
+    ('lineno', np.int32),
+    ('b1', np.int32),
+    ('b2', np.int32),
+    ('x', np.int32),
+    ('y', np.int32),
+    ('color', np.int32, 4),
+])
+
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
+
+def check_int32(nums, move):
+    for x in nums:
+        if not INT32_MIN <= x <= INT32_MAX:
+            raise ParseError(f'Number {x} is out of range', move.meta)
+
+def compile_moves(moves):
+    names = {}
+    def intern(name):
+        if name not in names:
+            names[name] = len(names)
+        return names[name]
+    rows = []
+    for move in moves:
+        lineno = move.lineno if move.lineno is not None else len(rows)+1
+        if isinstance(move, ColorMove):
+            check_int32(move.color, move)
+            row = (OP_COLOR, lineno, intern(move.block), -1, 0, 0, move.color)
+        elif isinstance(move, SwapMove):
+            row = (OP_SWAP, lineno, intern(move.block1), intern(move.block2), 0, 0, (0,0,0,0))
+        elif isinstance(move, MergeMove):
+            row = (OP_MERGE, lineno, intern(move.block1), intern(move.block2), 0, 0, (0,0,0,0))
+        elif isinstance(move, LineCutMove):
+            op = OP_LINE_CUT_X if move.orientation == 'x' else OP_LINE_CUT_Y
+            check_int32((move.pos,), move)
+            row = (op, lineno, intern(move.block), -1, move.pos, 0, (0,0,0,0))
+        elif isinstance(move, PointCutMove):
+            check_int32(move.point, move)
+            row = (OP_POINT_CUT, lineno, intern(move.block), -1, *move.point, (0,0,0,0))
+        else:
+            raise NotImplementedError()
+        rows.append(row)
+    ops = np.array(rows, dtype=MOVE_DTYPE)
+    return ops, np.array(list(names), dtype=str)
+
+# Rows of a compiled program as tuples of plain Python ints.
+def iter_rows(ops):
+    cols = [ops[k].tolist() for k in MOVE_DTYPE.names]
+    return zip(*cols)
+
+def row_to_move(row, names, src=None):
+    op, lineno, b1, b2, x, y, color = row
+    if op == OP_COLOR:
+        return ColorMove(names[b1], tuple(color), lineno=lineno, src=src)
+    elif op == OP_SWAP:
+        return SwapMove(names[b1], names[b2], lineno=lineno, src=src)
+    elif op == OP_MERGE:
+        return MergeMove(names[b1], names[b2], lineno=lineno, src=src)
+    elif op == OP_LINE_CUT_X:
+        return LineCutMove(names[b1], 'x', x, lineno=lineno, src=src)
+    elif op == OP_LINE_CUT_Y:
+        return LineCutMove(names[b1], 'y', x, lineno=lineno, src=src)
+    elif op == OP_POINT_CUT:
+        return PointCutMove(names[b1], (x, y), lineno=lineno, src=src)
+    else:
+        raise NotImplementedError()
+
+# Moves of a compiled program, keeping the line numbers of the source program.
+def iter_compiled(prog):
+    ops, names = prog
+    names = names.tolist()
+    src = Source(compiled=prog)
+    for row in iter_rows(ops):
+        yield row_to_move(row, names, src)
+
+def save_compiled(fname, prog):
+    ops, names = prog
+    np.savez(fname, ops=ops, names=names)
+
+def load_compiled(fname):
+    with np.load(fname) as f:
+        return f['ops'], f['names']
+
+def sidecar_fname(fname):
+    return fname + '.npz'
+
+# Compiled form of the program in `fname`, from its .npz sidecar when that is
+# up to date. Otherwise the program is parsed and the sidecar (re)written.
+def load_program(fname, *, write_sidecar=True):
+    if fname.endswith('.npz'):
+        return load_compiled(fname)
+    side = sidecar_fname(fname)
+    if os.path.exists(side) and os.path.getmtime(side) >= os.path.getmtime(fname):
+        return load_compiled(side)
+    with open(fname, 'r') as f:
+        prog = compile_moves(iter_program(f))
+    if write_sidecar:
+        save_compiled(side, prog)
+    return prog
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fnames', type=str, nargs='+')
+    parser.add_argument('--decompile', action='store_true',
+                        help='print compiled programs back as ISL')
+    args = parser.parse_args()
+    for fname in args.fnames:
+        if args.decompile:
+            print(format_program(iter_compiled(load_compiled(fname))), end='')
+        else:
+            with open(fname, 'r') as f:
+                prog = compile_moves(iter_program(f))
+            save_compiled(sidecar_fname(fname), prog)
+            print(f'{fname}: {len(prog[0])} moves, {len(prog[1])} block names')
+
+if __name__ == '__main__': main()
@@ -4,10 +4,16 @@
 import argparse
 from PIL import Image
 import numpy as np
+import os
 import scipy as sp
 import scipy.optimize
 import sys
 
+import colorcache
+import constants
+import lang
+import regions
+import sim
 import svgparse
 
 def eprint(*args, **kwargs):
@@ -17,10 +23,17 @@ def color_to_str(x):
     assert len(x) == 4
     return f"[{x[0]}, {x[1]}, {x[2]}, {x[3]}]"
 
+# A color as the plain int tuple lang.parse_color gives (sim rejects numpy ints).
+def color_tuple(x):
+    assert len(x) == 4
+    return tuple(np.asarray(x).tolist())
+
 
-ALPHA = 0.005
-NCHAN = 4
+ALPHA = constants.ALPHA
+NCHAN = constants.NCHAN
 NBLOCKS = 0
+# set to None to always re-solve grid colors
+COLOR_CACHE = colorcache.ColorCache()
 # NBLOCKS_LOG2 = 4
 # NBLOCKS = 2**NBLOCKS_LOG2
 # NBLOCKS = 16
@@ -29,22 +42,153 @@ def load(fname):
     img = Image.open(fname)
     return np.flip(np.swapaxes(np.asarray(img.convert("RGBA")), 0, 1), axis=1)
 
+# Sidecar directory of .npy files written by problems.py for the PNG `fname`.
+def prep_dir(fname):
+    return fname + '.prep'
+
+# Like load, but memory-maps the preprocessed canvas-orientation image (or
+# another array `name` from problems.PREP_ARRAYS) read-only when its sidecar is
+# up to date, so concurrent workers share one page-cache copy. Falls back to
+# decoding the PNG for images.
+def load_mapped(fname, name='img'):
+    side = os.path.join(prep_dir(fname), name + '.npy')
+    if os.path.exists(side) and os.path.getmtime(side) >= os.path.getmtime(fname):
+        return np.load(side, mmap_mode='r')
+    if name != 'img':
+        raise FileNotFoundError(f'{side} is missing or stale, run problems.py {fname}')
+    return load(fname)
+
 def save(arr, fname):
     img = Image.fromarray(np.swapaxes(np.flip(arr, axis=1), 0, 1), mode='RGBA')
     img.save(fname)
 
-def optimize_color(arr):
+# Reference per-cell solver, kept for checking optimize_colors against.
+def optimize_color_cg(arr):
     f = lambda x: ALPHA * np.sum(np.sqrt(np.sum((arr - x)**2, axis=-1)))
     x0 = np.array([127.0]*NCHAN)
     res = sp.optimize.minimize(f, x0, method='CG', tol=0.01)
     cost = f(res.x)
     return res.x, cost
 
-def diff_cost(arr1, arr2):
+def optimize_color(arr):
+    colors, costs = optimize_colors(arr.reshape(1, -1, NCHAN))
+    return colors[0], costs[0]
+
+# Batched geometric median over many cells at once, using Weiszfeld iterations
+# with the Vardi-Zhang correction for iterates that land on a pixel value,
+# warm-started from `x0` (ncells, NCHAN), by default the per-channel median.
+# `cells` has shape (ncells, npix, NCHAN). A cell is done once its color moves by less than `tol`. Versus the
+# per-cell CG solve in optimize_color_cg, the cost of each cell is never more than
+# COLOR_COST_RTOL (relative) above the CG cost. Rounded colors can still differ
+# on cells where the cost is nearly flat between several pixel values.
+COLOR_TOL = 0.01
+COLOR_COST_RTOL = 1e-3
+def optimize_colors(cells, *, x0=None, tol=COLOR_TOL, max_iter=1000):
+    cells = np.asarray(cells, dtype=np.float64)
+    x = np.median(cells, axis=1) if x0 is None else np.array(x0, dtype=np.float64)
+    active = np.arange(x.shape[0])
+    for _ in range(max_iter):
+        pts = cells[active]
+        xa = x[active]
+        delta = pts - xa[:,None]
+        d = np.sqrt(np.sum(delta**2, axis=-1))
+        hit = d < 1e-9
+        w = np.where(hit, 0.0, 1.0 / np.where(hit, 1.0, d))
+        wsum = np.sum(w, axis=1)
+        T = np.sum(pts * w[...,None], axis=1) / np.maximum(wsum, 1e-300)[:,None]
+        R = np.sqrt(np.sum(np.sum(delta * w[...,None], axis=1)**2, axis=-1))
+        eta = np.sum(hit, axis=1)
+        gamma = np.minimum(1.0, eta / np.maximum(R, 1e-300))
+        x_new = (1 - gamma)[:,None] * T + gamma[:,None] * xa
+        # every pixel on the current point
+        x_new[wsum == 0] = xa[wsum == 0]
+        step = np.max(np.abs(x_new - xa), axis=-1)
+        x[active] = x_new
+        active = active[step > tol]
+        if len(active) == 0: break
+    cost = ALPHA * np.sum(np.sqrt(np.sum((cells - x[:,None])**2, axis=-1)), axis=-1)
+    return x, cost
+
+# optimize_colors for groups of any size: the geometric median of the
+# `pixels` (npix, NCHAN) with each label in 0..n-1, all labels at once,
+# warm-started from their means. Labels with no pixels come out nan.
+def optimize_label_colors(pixels, labels, n, *, tol=COLOR_TOL, max_iter=1000):
+    pixels = np.asarray(pixels, dtype=np.float64)
+    count = np.bincount(labels, minlength=n).astype(np.float64)
+    group_sum = lambda v, lab, m: np.stack(
+        [np.bincount(lab, v[:, k], minlength=m) for k in range(v.shape[1])], axis=-1)
+    with np.errstate(invalid='ignore'):
+        x = group_sum(pixels, labels, n) / count[:, None]
+    active = np.flatnonzero(count > 0)
+    for _ in range(max_iter):
+        # pixels of the active labels, relabelled 0..len(active)-1
+        remap = np.full(n, -1)
+        remap[active] = np.arange(len(active))
+        sel = remap[labels] >= 0
+        pts = pixels[sel]
+        lab = remap[labels[sel]]
+        m = len(active)
+        xa = x[active]
+        delta = pts - xa[lab]
+        d = np.sqrt(np.sum(delta**2, axis=-1))
+        hit = d < 1e-9
+        w = np.where(hit, 0.0, 1.0 / np.where(hit, 1.0, d))
+        wsum = np.bincount(lab, w, minlength=m)
+        T = group_sum(pts * w[:, None], lab, m) / np.maximum(wsum, 1e-300)[:, None]
+        R = np.sqrt(np.sum(group_sum(delta * w[:, None], lab, m)**2, axis=-1))
+        eta = np.bincount(lab, hit, minlength=m)
+        gamma = np.minimum(1.0, eta / np.maximum(R, 1e-300))
+        x_new = (1 - gamma)[:, None] * T + gamma[:, None] * xa
+        # every pixel on the current point
+        x_new[wsum == 0] = xa[wsum == 0]
+        step = np.max(np.abs(x_new - xa), axis=-1)
+        x[active] = x_new
+        active = active[step > tol]
+        if len(active) == 0: break
+    return x
+
+# Reference similarity cost, kept for checking diff_cost against.
+def diff_cost_naive(arr1, arr2):
     arr1 = arr1.astype(int)
     arr2 = arr2.astype(int)
     return ALPHA * np.sum(np.sqrt(np.sum((arr1 - arr2)**2, axis=-1)))
 
+# sqrt of every possible squared distance between two uint8 colors
+SQRT_LUT = np.sqrt(np.arange(NCHAN * 255**2 + 1, dtype=np.float64))
+# pixels per diff_cost tile, so the int32 scratch buffers stay in cache
+DIFF_TILE = 1 << 15
+
+# Similarity cost for uint8 images: squared channel differences accumulate in
+# int32 over cache-sized tiles of rows and go through SQRT_LUT instead of sqrt.
+# Tiles are views, so flipped/strided inputs (e.g. from load) are never copied.
+# Tiles where both alphas are all 255 skip the alpha channel. Anything else
+# falls back to diff_cost_naive.
+def diff_cost(arr1, arr2):
+    if arr1.dtype != np.uint8 or arr2.dtype != np.uint8 or arr1.shape != arr2.shape:
+        return diff_cost_naive(arr1, arr2)
+    if arr1.size == 0:
+        return 0.0
+    a = arr1 if arr1.ndim == 3 else arr1.reshape(-1, 1, NCHAN)
+    b = arr2 if arr2.ndim == 3 else arr2.reshape(-1, 1, NCHAN)
+    rows = max(1, DIFF_TILE // a.shape[1])
+    d2 = np.empty((min(rows, a.shape[0]), a.shape[1]), dtype=np.int32)
+    tmp = np.empty_like(d2)
+    total = 0.0
+    for start in range(0, a.shape[0], rows):
+        ta = a[start:start+rows]
+        tb = b[start:start+rows]
+        acc = d2[:len(ta)]
+        t = tmp[:len(ta)]
+        opaque = ta[..., 3].min() == 255 and tb[..., 3].min() == 255
+        np.subtract(ta[..., 0], tb[..., 0], out=acc, dtype=np.int32)
+        np.multiply(acc, acc, out=acc)
+        for c in range(1, 3 if opaque else NCHAN):
+            np.subtract(ta[..., c], tb[..., c], out=t, dtype=np.int32)
+            np.multiply(t, t, out=t)
+            acc += t
+        total += SQRT_LUT.take(acc).sum()
+    return ALPHA * total
+
 class Color:
     def __init__(self, r, g, b, a):
         self.red = r
@@ -61,140 +205,344 @@ class Rect:
         self.fill = Color(*color)
 
 
+# Quadtree of point cuts down to single cells, yielding lang moves in the same
+# (depth first, children 0..3) order as the recursive version did.
 def draw_pow2_grid(x, y, wx, wy, color_blocks, *, bid, level):
     N = 2**level
     assert color_blocks.shape == (N, N, NCHAN)
-    if level == 0:
-        color = color_blocks[0,0]
-        return [f"color [{bid}] {color_to_str(color)}"]
-    assert wx % 2 == 0 and  wy % 2 == 0
-    wx_p = wx // 2
-    wy_p = wy // 2
-    mx, my = x + wx_p, y + wy_p
-    cmds = [f"cut [{bid}] [{mx},{my}]"]
-    cmds.extend(draw_pow2_grid(
-        x, y, wx_p, wy_p, color_blocks[:N//2, :N//2],
-        bid=f"{bid}.0", level=level-1))
-    cmds.extend(draw_pow2_grid(
-        x+wx_p, y, wx_p, wy_p, color_blocks[N//2:, :N//2],
-        bid=f"{bid}.1", level=level-1))
-    cmds.extend(draw_pow2_grid(
-        x+wx_p, y+wy_p, wx_p, wy_p, color_blocks[N//2:, N//2:],
-        bid=f"{bid}.2", level=level-1))
-    cmds.extend(draw_pow2_grid(
-        x, y+wy_p, wx_p, wy_p, color_blocks[:N//2, N//2:],
-        bid=f"{bid}.3", level=level-1))
-    return cmds
+    stack = [(x, y, wx, wy, color_blocks, bid, level)]
+    while stack:
+        x, y, wx, wy, color_blocks, bid, level = stack.pop()
+        N = 2**level
+        if level == 0:
+            color = color_blocks[0,0]
+            yield lang.ColorMove(bid, color_tuple(color))
+            continue
+        assert wx % 2 == 0 and  wy % 2 == 0
+        wx_p = wx // 2
+        wy_p = wy // 2
+        mx, my = x + wx_p, y + wy_p
+        yield lang.PointCutMove(bid, (mx, my))
+        stack.append((x, y+wy_p, wx_p, wy_p, color_blocks[:N//2, N//2:], f"{bid}.3", level-1))
+        stack.append((x+wx_p, y+wy_p, wx_p, wy_p, color_blocks[N//2:, N//2:], f"{bid}.2", level-1))
+        stack.append((x+wx_p, y, wx_p, wy_p, color_blocks[N//2:, :N//2], f"{bid}.1", level-1))
+        stack.append((x, y, wx_p, wy_p, color_blocks[:N//2, :N//2], f"{bid}.0", level-1))
 
+# Raster of rows (ori vert*) or columns (horiz*) of cells, one band at a time:
+# the remaining block gets the band's first color, then each further cell is
+# cut off, colored and merged back, and the band is cut away. Yields lang
+# moves as it goes, so memory stays constant in the grid size.
 def cheap_grid(x, y, bx, by, color_blocks, *, bid, gid, ori, bleed):
     Nx = color_blocks.shape[0]
     Ny = color_blocks.shape[1]
     assert color_blocks.shape[2] == NCHAN and len(color_blocks.shape) == 3
-    if Nx == 0 or Ny == 0: return []
+    if Nx == 0 or Ny == 0: return
 
-    cmds = []
-    c00 = color_blocks[0,0]
-    cmds.append(f'color [{bid}] {color_to_str(c00)}')
     if ori.startswith('vert'):
-        NA, NB = Nx, Ny
         oA, oB = 'x', 'y'
         bA, bB = bx, by
-        a, b = x, y
-        if ori.endswith('A'):
-            next_coord = (x, y+by)
-            next_b = y + by
-            next_slice = (slice(None), slice(1, None))
-            make_ind = lambda i: (i,0)
-        else:
-            assert ori.endswith('B')
-            next_coord = (x, y-by)
-            next_b = y - by
-            next_slice = (slice(None), slice(0, -1))
-            make_ind = lambda i: (i,-1)
+        b = y
     else:
         assert ori.startswith('horiz')
-        NA, NB = Ny, Nx
         oA, oB = 'y', 'x'
         bA, bB = by, bx
-        a, b = y, x
-        if ori.endswith('A'):
-            next_coord = (x+bx, y)
-            next_b = x + bx
-            next_slice = (slice(1, None), slice(None))
-            make_ind = lambda i: (0,i)
-        else:
-            assert ori.endswith('B')
-            next_coord = (x-bx, y)
-            next_b = x - bx
-            next_slice = (slice(0, -1), slice(None))
-            make_ind = lambda i: (-1,i)
+        b = x
+    assert ori.endswith('A') or ori.endswith('B')
     if ori.endswith('A'):
         next_side = '1'
+        step = bB
     else:
         next_side = '0'
-    for i in range(1, NA-bleed[0]):
-        cmds.append(f'cut [{bid}] [{oA}] [{i*bA}]')
-        ci0 = color_blocks[make_ind(i)]
-        cmds.append(f'color [{bid}.1] {color_to_str(ci0)}')
-        cmds.append(f'merge [{bid}.0] [{bid}.1]')
-        bid = str(gid+1)
-        gid += 1
-    if NB > 1+bleed[1]:
-        cmds.append(f'cut [{bid}] [{oB}] [{next_b}]')
+        step = -bB
+    # the rows (columns) still to paint, as a view of color_blocks; NOTE: the
+    # first color of every band is c00 of this view, which for the B
+    # orientations is always color_blocks[0,0]
+    k = 0
+    while True:
+        if ori == 'vertA':
+            cb = color_blocks[:, k:]
+            make_ind = lambda i: (i,0)
+        elif ori == 'vertB':
+            cb = color_blocks[:, :Ny-k]
+            make_ind = lambda i: (i,-1)
+        elif ori == 'horizA':
+            cb = color_blocks[k:, :]
+            make_ind = lambda i: (0,i)
+        else:
+            cb = color_blocks[:Nx-k, :]
+            make_ind = lambda i: (-1,i)
+        if ori.startswith('vert'):
+            NA, NB = cb.shape[0], cb.shape[1]
+        else:
+            NA, NB = cb.shape[1], cb.shape[0]
+        yield lang.ColorMove(bid, color_tuple(cb[0,0]))
+        for i in range(1, NA-bleed[0]):
+            yield lang.LineCutMove(bid, oA, i*bA)
+            ci0 = cb[make_ind(i)]
+            yield lang.ColorMove(f'{bid}.1', color_tuple(ci0))
+            yield lang.MergeMove(f'{bid}.0', f'{bid}.1')
+            bid = str(gid+1)
+            gid += 1
+        if NB <= 1+bleed[1]:
+            return
+        b += step
+        yield lang.LineCutMove(bid, oB, b)
         bid = f'{bid}.{next_side}'
-        cmds.extend(cheap_grid(
-            *next_coord, bx, by, color_blocks[next_slice], bid=bid, gid=gid, ori=ori, bleed=bleed))
-    # elif ori == 'horiz':
-    #     for i in range(1, Ny):
-    #         cmds.append(f'cut [{bid}] [y] [{i*by}]')
-    #         ci0 = color_blocks[0,i]
-    #         cmds.append(f'color [{bid}.1] {color_to_str(ci0)}')
-    #         cmds.append(f'merge [{bid}.0] [{bid}.1]')
-    #         bid = str(gid+1)
-    #         gid += 1
-    #     if Nx > 1+bleed:
-    #         cmds.append(f'cut [{bid}] [x] [{x+bx}]')
-    #         bid = f'{bid}.1'
-    #         cmds.extend(cheap_grid(
-    #             x+bx, y, bx, by, color_blocks[1:,:], bid=bid, gid=gid, ori=ori, bleed=bleed))
-    # else:
-    #     raise RuntimeError()
-    return cmds
+        k += 1
             
-def solve(img, orientation, bleed):
-    assert img.shape[0] % NBLOCKS == 0
-    assert img.shape[1] % NBLOCKS == 0
-    bx = img.shape[0] // NBLOCKS
-    by = img.shape[1] // NBLOCKS
-    blocked = img.reshape(NBLOCKS, bx, NBLOCKS, by, NCHAN)
+# Optimal (rounded) color of every cell of an n_blocks x n_blocks grid, along
+# with the cell pixels, indexed [bi, bj], and the total unrounded cost.
+# Cells that are a single flat color (zero variance in `stats`, a
+# regions.RegionStats of img) take that color at zero cost without going
+# through the solver, and the rest start it from their mean.
+def grid_colors(img, n_blocks, *, stats=None):
+    assert img.shape[0] % n_blocks == 0
+    assert img.shape[1] % n_blocks == 0
+    bx = img.shape[0] // n_blocks
+    by = img.shape[1] // n_blocks
+    blocked = img.reshape(n_blocks, bx, n_blocks, by, NCHAN)
     blocked = np.swapaxes(blocked, 1, 2)
-    rects = []
-    color_blocks = []
-    tot_cost = 0
-    for bi in range(NBLOCKS):
-        for bj in range(NBLOCKS):
-            cij, cost = optimize_color(blocked[bi,bj].astype(np.float64))
-            cij = np.clip(np.around(cij).astype(int), 0, 255)
-            rects.append(Rect(bi*bx, bj*by, bx, by, cij))
-            # eprint(rects[-1], cost)
-            color_blocks.append(cij)
-            tot_cost += cost
+    cells = blocked.reshape(n_blocks, n_blocks, bx*by, NCHAN)
+    if COLOR_CACHE is not None:
+        key = colorcache.grid_key(img, (n_blocks, n_blocks), COLOR_TOL)
+        hit = COLOR_CACHE.get(key, ('colors', 'costs'))
+        if hit is not None:
+            color_blocks, costs = hit
+            return color_blocks, cells, float(np.sum(costs))
+    if stats is None:
+        stats = regions.RegionStats(img)
+    rects = regions.grid_rects(img.shape, n_blocks).reshape(-1, 4)
+    flat = stats.l2_cost(rects) == 0
+    colors = stats.mean(rects)
+    costs = np.zeros(len(rects))
+    if not np.all(flat):
+        colors[~flat], costs[~flat] = optimize_colors(
+            cells.reshape(n_blocks*n_blocks, bx*by, NCHAN)[~flat], x0=colors[~flat])
+    color_blocks = np.clip(np.around(colors).astype(int), 0, 255).reshape(
+        (n_blocks, n_blocks, NCHAN))
+    if COLOR_CACHE is not None:
+        COLOR_CACHE.put(key, colors=color_blocks, costs=costs.reshape(n_blocks, n_blocks))
+    return color_blocks, cells, np.sum(costs)
+
+# Moves for the NBLOCKS grid, generated lazily. Scoring feeds these straight
+# to sim.run_program; ISL text is only made when writing output.
+def solve_moves(img, orientation, bleed):
+    color_blocks, _, tot_cost = grid_colors(img, NBLOCKS)
     eprint(f'solution found with cost {tot_cost}')
-    color_blocks = np.stack(color_blocks).reshape(
-        (NBLOCKS, NBLOCKS, NCHAN))
 
     # cmds = svgparse.draw_rects(rects)
     # cmds = draw_pow2_grid(0, 0, *img.shape[:2], color_blocks, bid='0', level=NBLOCKS_LOG2)
+    return grid_moves(img.shape, color_blocks, orientation, bleed)
+
+# solve_moves as a list of ISL commands.
+def solve(img, orientation, bleed):
+    return list(map(lang.format_move, solve_moves(img, orientation, bleed)))
+
+# cheap_grid moves (a generator) painting `color_blocks` over a canvas of
+# `shape`.
+def grid_moves(shape, color_blocks, orientation, bleed):
+    bx = shape[0] // color_blocks.shape[0]
+    by = shape[1] // color_blocks.shape[1]
     x0 = 0
     y0 = 0
     if orientation == 'vertB':
-        y0 = img.shape[1]
+        y0 = shape[1]
     if orientation == 'horizB':
-        x0 = img.shape[0]
-    cmds = cheap_grid(
+        x0 = shape[0]
+    moves = cheap_grid(
         x0, y0, bx, by, color_blocks, bid='0', gid=0, ori=orientation,
         bleed=bleed)
-    return cmds
+    return moves
+
+def grid_cmds(shape, color_blocks, orientation, bleed):
+    return list(map(lang.format_move, grid_moves(shape, color_blocks, orientation, bleed)))
+
+# The cheap_grid raster over arbitrary breakpoints: cell [i, j] covers
+# xs[i]..xs[i+1] x ys[j]..ys[j+1], and xs, ys run from 0 to the canvas size.
+# Unlike cheap_grid, the first cell of every band gets its own color in the B
+# orientations too.
+def breakpoint_grid(xs, ys, color_blocks, *, bid, gid, ori, bleed=(0, 0)):
+    assert color_blocks.shape == (len(xs) - 1, len(ys) - 1, NCHAN)
+    if ori.startswith('vert'):
+        A, B, oA, oB = xs, ys, 'x', 'y'
+        cell = lambda i, j: color_blocks[i, j]
+    else:
+        assert ori.startswith('horiz')
+        A, B, oA, oB = ys, xs, 'y', 'x'
+        cell = lambda i, j: color_blocks[j, i]
+    NA, NB = len(A) - 1, len(B) - 1
+    bands = range(NB) if ori.endswith('A') else range(NB - 1, -1, -1)
+    for k, j in enumerate(bands):
+        yield lang.ColorMove(bid, color_tuple(cell(0, j)))
+        for i in range(1, NA - bleed[0]):
+            yield lang.LineCutMove(bid, oA, int(A[i]))
+            yield lang.ColorMove(f'{bid}.1', color_tuple(cell(i, j)))
+            yield lang.MergeMove(f'{bid}.0', f'{bid}.1')
+            gid += 1
+            bid = str(gid)
+        if NB - k <= 1 + bleed[1]:
+            break
+        if ori.endswith('A'):
+            yield lang.LineCutMove(bid, oB, int(B[j+1]))
+            bid = f'{bid}.1'
+        else:
+            yield lang.LineCutMove(bid, oB, int(B[j]))
+            bid = f'{bid}.0'
+
+# Optimal (rounded) colors and costs of the cells of a breakpoint grid, solved
+# in one batch per distinct cell shape and started from the cell means.
+def cell_colors(img, xs, ys, *, stats=None):
+    if stats is None:
+        stats = regions.RegionStats(img)
+    x0, y0 = np.meshgrid(xs[:-1], ys[:-1], indexing='ij')
+    x1, y1 = np.meshgrid(xs[1:], ys[1:], indexing='ij')
+    rects = np.stack([x0, y0, x1, y1], axis=-1).reshape(-1, 4)
+    colors = stats.mean(rects)
+    costs = np.zeros(len(rects))
+    todo = np.flatnonzero(stats.l2_cost(rects) != 0)
+    shapes = rects[todo, 2:] - rects[todo, :2]
+    for shape in np.unique(shapes, axis=0):
+        idx = todo[np.all(shapes == shape, axis=1)]
+        cells = np.stack([img[x0:x1, y0:y1].reshape(-1, NCHAN) for x0, y0, x1, y1 in rects[idx]])
+        colors[idx], costs[idx] = optimize_colors(cells, x0=colors[idx])
+    color_blocks = np.clip(np.around(colors).astype(int), 0, 255).reshape(
+        (len(xs) - 1, len(ys) - 1, NCHAN))
+    return color_blocks, costs.reshape(len(xs) - 1, len(ys) - 1)
+
+# How many times an image of `shape` can be halved with both sides staying
+# whole (4 for 400x400: 200, 100, 50, 25).
+def max_pyramid_levels(shape):
+    W, H = shape[:2]
+    levels = 0
+    while W > 1 and H > 1 and W % 2 == 0 and H % 2 == 0:
+        W, H = W // 2, H // 2
+        levels += 1
+    return levels
+
+# [img, img mean-pooled 2x2, ...], `levels` halvings in all. Raises ValueError
+# past max_pyramid_levels.
+def pyramid(img, levels):
+    if not 0 <= levels <= max_pyramid_levels(img.shape):
+        raise ValueError(f'{levels} pyramid levels do not fit a {img.shape[0]}x{img.shape[1]} '
+                         f'image, at most {max_pyramid_levels(img.shape)} halvings keep both '
+                         f'sides even')
+    out = [img]
+    for _ in range(levels):
+        a = out[-1]
+        W, H = a.shape[:2]
+        pooled = a.reshape(W // 2, 2, H // 2, 2, NCHAN).mean(axis=(1, 3))
+        out.append(np.around(pooled).astype(np.uint8))
+    return out
+
+# Coarse to fine breakpoint grid: breakpoints.optimize_pyramid picks the
+# breakpoints, colors are solved on the full image.
+def solve_pyramid_moves(img, levels, *, step=1):
+    import breakpoints
+    _, ori, xs, ys = breakpoints.optimize_pyramid(img, levels=levels, step=step)
+    return solve_breaks_moves(img, xs, ys, ori)
+
+# solve_moves over the breakpoint grid xs x ys instead of an NBLOCKS grid.
+def solve_breaks_moves(img, xs, ys, orientation, bleed=(0, 0)):
+    color_blocks, costs = cell_colors(img, xs, ys)
+    eprint(f'solution found with cost {np.sum(costs)}')
+    return breakpoint_grid(xs, ys, color_blocks, bid='0', gid=0, ori=orientation, bleed=bleed)
+
+def solve_breaks(img, xs, ys, orientation, bleed=(0, 0)):
+    return list(map(lang.format_move, solve_breaks_moves(img, xs, ys, orientation, bleed)))
+
+
+### Exact cost model of the cheap_grid raster, without generating or simulating
+### any commands.
+
+GRID_ORIENTS = ['vertA', 'vertB', 'horizA', 'horizB']
+
+# Grid arrays indexed the way cheap_grid visits them: [i, j] is the i'th cell
+# along raster row j, both in painting order.
+def orient_grid(a, orient):
+    if orient == 'vertA':
+        return a
+    elif orient == 'vertB':
+        return a[:, ::-1]
+    elif orient == 'horizA':
+        return np.swapaxes(a, 0, 1)
+    elif orient == 'horizB':
+        return np.swapaxes(a[::-1], 0, 1)
+    else:
+        raise RuntimeError()
+
+# Execution cost of cheap_grid for every (bleed_A, bleed_B) up to max_bleed,
+# as an int array indexed [bleed_A, bleed_B]. Row j (of R = n - bleed_B rows)
+# colors the whole remaining canvas, then for each of its K = n - bleed_A - 1
+# cuts colors everything past the cut and merges back, then cuts the row off.
+def grid_exec_costs(shape, n_blocks, orient, max_bleed):
+    n = n_blocks
+    W, H = shape[:2]
+    LA, LB = (W, H) if orient.startswith('vert') else (H, W)
+    bA, bB = LA // n, LB // n
+    def cost(base, size):
+        return sim.compute_costs(base, size, W * H).astype(np.int64)
+    E = LB - np.arange(n) * bB # extent left along B at row j
+    i = np.arange(1, n) * bA # cut positions along A
+    per_cut = (cost(sim.LINE_CUT_COST, LA * E)[:,None] +
+               cost(sim.COLOR_COST, (LA - i)[None,:] * E[:,None]) +
+               cost(sim.MERGE_COST, np.maximum(i, LA - i)[None,:] * E[:,None]))
+    row = cost(sim.COLOR_COST, LA * E)[:,None] + np.concatenate(
+        (np.zeros((n, 1), dtype=np.int64), np.cumsum(per_cut, axis=1)), axis=1)
+    row_cum = np.concatenate((np.zeros((1, n), dtype=np.int64), np.cumsum(row, axis=0)))
+    row_cut_cum = np.concatenate(([0], np.cumsum(cost(sim.LINE_CUT_COST, LA * E))))
+    nb = min(max_bleed, n-1) + 1
+    bleed = np.arange(nb)
+    K = n - 1 - bleed # index of the last cell painted in a row
+    R = n - bleed # number of rows painted
+    return row_cum[R[None,:], K[:,None]] + row_cut_cum[R-1][None,:]
+
+# Similarity cost (unrounded) of the cheap_grid image for every (bleed_A,
+# bleed_B) up to max_bleed, indexed [bleed_A, bleed_B]. Cells past the last
+# painted cell K of a row keep its color, rows past the last painted row R-1
+# keep its colors.
+def grid_sim_costs(color_blocks, cells, orient, max_bleed):
+    n = color_blocks.shape[0]
+    C = orient_grid(color_blocks, orient).astype(np.float64)
+    P = orient_grid(cells, orient).astype(np.float64)
+    if orient.endswith('B'):
+        # NOTE: cheap_grid starts every row with color_blocks[0,0] (c00), which
+        # for the B orientations is the first cell of the last row painted.
+        C = C.copy()
+        C[0,:] = C[0,-1]
+    def cost(pix, color):
+        return ALPHA * np.sum(np.sqrt(np.sum((pix - color[...,None,:])**2, axis=-1)), axis=-1)
+    nb = min(max_bleed, n-1) + 1
+    Ks = n - 1 - np.arange(nb)
+    Rs = n - np.arange(nb)
+    # own colors, summed over i <= K and j < R
+    own = np.zeros((n+1, n+1))
+    own[1:,1:] = np.cumsum(np.cumsum(cost(P, C), axis=0), axis=1)
+    out = own[Ks[:,None]+1, Rs[None,:]]
+    for b, R in enumerate(Rs):
+        if R == n: continue
+        # cells i <= K of rows j >= R take color [i, R-1]
+        bottom = np.sum(cost(P[:,R:], C[:,R-1][:,None]), axis=1)
+        out[:,b] += np.cumsum(bottom)[Ks]
+    for a, K in enumerate(Ks):
+        if K == n-1: continue
+        # cells i > K of rows j < R take color [K, j]
+        side = np.sum(cost(P[K+1:], C[K][None]), axis=0)
+        out[a] += np.concatenate(([0], np.cumsum(side)))[Rs]
+        # and the corner i > K, j >= R takes color [K, R-1]
+        for b, R in enumerate(Rs):
+            if R == n: continue
+            out[a,b] += np.sum(cost(P[K+1:,R:], C[K,R-1][None,None]))
+    return out
+
+# Exact total cost (execution plus rounded similarity, as sim.py scores it) of
+# solve() with this grid, orientation and bleed.
+def estimate_cost(img, n_blocks, orient, bleed, *, grid=None):
+    color_blocks, cells, _ = grid if grid is not None else grid_colors(img, n_blocks)
+    max_bleed = max(bleed)
+    exec_costs = grid_exec_costs(img.shape, n_blocks, orient, max_bleed)
+    sim_costs = grid_sim_costs(color_blocks, cells, orient, max_bleed)
+    ba, bb = (min(b, n_blocks-1) for b in bleed)
+    return exec_costs[ba,bb] + round(sim_costs[ba,bb])
 
 def main():
     parser = argparse.ArgumentParser()
@@ -203,12 +551,27 @@ def main():
     parser.add_argument('-O', '--orientation', type=str, default='vertA')
     parser.add_argument('--bleed_A', type=int, default=0, help='bleed A pixels per raster row')
     parser.add_argument('--bleed_B', type=int, default=0, help='bleed the last B raster rows')
+    parser.add_argument('--no-cache', action='store_true', help='always re-solve grid colors')
+    parser.add_argument('--pyramid', type=int, default=0,
+                        help='plan a breakpoint grid this many halvings down and refine it '
+                             'back up, instead of the NBLOCKS grid')
     args = parser.parse_args()
-    global NBLOCKS
+    global NBLOCKS, COLOR_CACHE
     NBLOCKS = args.n_blocks
-    img = load(args.input)
+    if args.no_cache:
+        COLOR_CACHE = None
+    img = load_mapped(args.input)
+    if args.pyramid > max_pyramid_levels(img.shape):
+        parser.error(f'--pyramid {args.pyramid} is too deep for a {img.shape[0]}x{img.shape[1]} '
+                     f'image, at most {max_pyramid_levels(img.shape)}')
     # print(np.all(img[:,:,3] == 255))
-    cmds = solve(img, args.orientation, (args.bleed_A, args.bleed_B))
-    print('\n'.join(cmds))
+    if args.pyramid > 0:
+        moves = solve_pyramid_moves(img, args.pyramid)
+    else:
+        moves = solve_moves(img, args.orientation, (args.bleed_A, args.bleed_B))
+    for move in moves:
+        print(lang.format_move(move))
+    if COLOR_CACHE is not None:
+        eprint(COLOR_CACHE.stats())
 
 if __name__ == '__main__': main()
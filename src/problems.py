@@ -0,0 +1,64 @@
+### One-shot preprocessing of problem PNGs into memory-mappable .npy files, so
+### paint.load_mapped never has to decode, convert or flip the image again.
+
+import argparse
+import glob
+import numpy as np
+import os
+
+import paint
+import regions
+
+# the repo's problem and program directories, wherever scripts are run from
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBLEMS_DIR = os.path.join(REPO_DIR, 'problems')
+PROGS_DIR = os.path.join(REPO_DIR, 'progs')
+
+# Every problem PNG in PROBLEMS_DIR.
+def all_problems():
+    return sorted(glob.glob(os.path.join(PROBLEMS_DIR, '*.png')))
+
+# name -> function of the canvas-orientation uint8 image
+PREP_ARRAYS = {
+    'img': lambda img: img,
+    # summed-area tables, padded so sat[x, y] covers img[:x, :y]
+    'sat': lambda img: regions.summed_area(img.astype(np.int64)),
+    'sat2': lambda img: regions.summed_area(img.astype(np.int64)**2),
+}
+
+def is_fresh(fname):
+    d = paint.prep_dir(fname)
+    return all(os.path.exists(os.path.join(d, name + '.npy')) and
+               os.path.getmtime(os.path.join(d, name + '.npy')) >= os.path.getmtime(fname)
+               for name in PREP_ARRAYS)
+
+# Each array goes to a temporary file that replaces the old one, so readers
+# mapping the previous version keep a consistent (if stale) copy.
+def preprocess(fname):
+    img = np.ascontiguousarray(paint.load(fname))
+    d = paint.prep_dir(fname)
+    os.makedirs(d, exist_ok=True)
+    for name, f in PREP_ARRAYS.items():
+        tmp = os.path.join(d, f'.{name}.{os.getpid()}.npy')
+        np.save(tmp, np.ascontiguousarray(f(img)))
+        os.replace(tmp, os.path.join(d, name + '.npy'))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fnames', type=str, nargs='*',
+                        help='problem PNGs (default: every PNG in the repo\'s problems/)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rebuild even when up to date')
+    args = parser.parse_args()
+    fnames = args.fnames or all_problems()
+    if not fnames:
+        parser.error(f'no problem PNGs in {PROBLEMS_DIR}')
+    for fname in fnames:
+        if not args.force and is_fresh(fname):
+            print(f'{fname}: up to date')
+            continue
+        preprocess(fname)
+        print(f'{fname}: wrote {paint.prep_dir(fname)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Re-fits the colors of an existing program to the pixels each color move
+# actually owns in the final image (sim provenance, so after every later cut,
+# merge, swap and overpaint), all moves at once with
+# paint.optimize_label_colors. Only color values change, so the execution
+# cost stays the same, and a move keeps its old color unless the rounded fit
+# is strictly better on its pixels, so the similarity cost never gets worse.
+import argparse
+import numpy as np
+
+import lang
+import paint
+import sim
+
+def start_state(args):
+    if args.initial_state is not None:
+        return sim.load_state(args.initial_state)
+    return sim.blank_state()
+
+# Per label similarity cost of giving the pixels with that label `colors`.
+def label_costs(pixels, labels, colors, n):
+    d = np.sqrt(np.sum((pixels - colors[labels])**2, axis=-1))
+    return paint.ALPHA * np.bincount(labels, d, minlength=n)
+
+# The moves with every color move refit. Returns (moves, number changed,
+# color moves owning no pixels).
+def recolor(moves, owner, img):
+    n = len(moves)
+    sel = owner.reshape(-1) >= 0
+    labels = owner.reshape(-1)[sel]
+    pixels = img.reshape(-1, paint.NCHAN)[sel].astype(np.float64)
+    fit = paint.optimize_label_colors(pixels, labels, n)
+    owned = np.bincount(labels, minlength=n) > 0
+    old = np.zeros((n, paint.NCHAN))
+    for i, move in enumerate(moves):
+        if isinstance(move, lang.ColorMove):
+            old[i] = move.color
+    new = np.clip(np.around(np.where(owned[:, None], fit, old)), 0, 255)
+    better = label_costs(pixels, labels, new, n) < label_costs(pixels, labels, old, n)
+    out = []
+    changed = 0
+    unused = 0
+    for i, move in enumerate(moves):
+        if isinstance(move, lang.ColorMove):
+            if not owned[i]:
+                unused += 1
+            elif better[i]:
+                move = lang.ColorMove(move.block, paint.color_tuple(new[i].astype(int)))
+                changed += 1
+        out.append(move)
+    return out, changed, unused
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True, help='target PNG')
+    parser.add_argument('-p', '--program', type=str, required=True)
+    parser.add_argument('-o', '--output', type=str, required=True)
+    parser.add_argument('--initial_state', type=str, default=None)
+    args = parser.parse_args()
+
+    img = paint.load_mapped(args.input)
+    with open(args.program) as f:
+        moves = list(lang.iter_program(f))
+    res = sim.run_program(start_state(args), moves, provenance=True)
+    before = paint.diff_cost(img, res['output'])
+    moves, changed, unused = recolor(moves, res['provenance'], img)
+    paint.eprint(f'{changed} colors refit, {unused} color moves own no pixels')
+
+    with open(args.output, 'w') as f:
+        new = sim.run_program(start_state(args), lang.write_moves(f, moves))
+    after = paint.diff_cost(img, new['output'])
+    assert new['cost'] == res['cost']
+    assert after <= before + 1e-6, (after, before)
+    print(f'Execution cost: {new["cost"]}')
+    print(f'Diff cost: {round(before)} -> {round(after)}')
+    print(f'Total cost: {res["cost"] + round(before)} -> {new["cost"] + round(after)}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+### Rectangle statistics of a target image in O(1) per query, from summed-area
+### tables of per-channel sums and squared sums.
+
+import numpy as np
+
+import constants
+
+# RegionStats.l2_cost is an upper bound on a region's similarity cost; scaled
+# down it tracks the real cost of planned leaves better (checked on problems
+# 1, 5, 9 and 20)
+EST_SCALE = 0.85
+
+# Zero-padded summed-area table: sat[x, y] = sum of a[:x, :y].
+def summed_area(a):
+    sat = np.zeros((a.shape[0]+1, a.shape[1]+1) + a.shape[2:], dtype=a.dtype)
+    np.cumsum(np.cumsum(a, axis=0), axis=1, out=sat[1:, 1:])
+    return sat
+
+# Rectangles are (x0, y0, x1, y1) with exclusive ends, either one as a tuple or
+# many as a (..., 4) array; every query broadcasts over the leading axes.
+class RegionStats:
+    def __init__(self, img=None, *, sat=None, sat2=None):
+        if sat is None:
+            sat = summed_area(np.asarray(img, dtype=np.int64))
+        if sat2 is None:
+            sat2 = summed_area(np.asarray(img, dtype=np.int64)**2)
+        self.sat = sat
+        self.sat2 = sat2
+
+    # Uses the summed-area tables from problems.py when they are up to date.
+    @staticmethod
+    def from_problem(fname):
+        import paint
+        try:
+            return RegionStats(sat=paint.load_mapped(fname, 'sat'),
+                               sat2=paint.load_mapped(fname, 'sat2'))
+        except FileNotFoundError:
+            return RegionStats(paint.load_mapped(fname))
+
+    def box(self, table, rects):
+        rects = np.asarray(rects)
+        x0, y0, x1, y1 = rects[..., 0], rects[..., 1], rects[..., 2], rects[..., 3]
+        return table[x1, y1] - table[x0, y1] - table[x1, y0] + table[x0, y0]
+
+    def count(self, rects):
+        rects = np.asarray(rects)
+        return (rects[..., 2] - rects[..., 0]) * (rects[..., 3] - rects[..., 1])
+
+    def sums(self, rects):
+        return self.box(self.sat, rects)
+
+    def sq_sums(self, rects):
+        return self.box(self.sat2, rects)
+
+    def mean(self, rects):
+        return self.sums(rects) / self.count(rects)[..., None]
+
+    # Per-channel population variance, from integer sums so flat regions are
+    # exactly zero.
+    def var(self, rects):
+        n = self.count(rects)[..., None]
+        s = self.sums(rects)
+        return (n * self.sq_sums(rects) - s * s) / (n * n)
+
+    # Sum over pixels of the squared distance to the mean color.
+    def sse(self, rects):
+        return self.count(rects) * np.sum(self.var(rects), axis=-1)
+
+    # ALPHA * sqrt(n * sse): by Cauchy-Schwarz an upper bound on the similarity
+    # cost of filling the rectangle with its mean color (and so also on the
+    # cost with its optimal color). Zero exactly when the region is flat.
+    def l2_cost(self, rects):
+        return constants.ALPHA * np.sqrt(self.count(rects) * self.sse(rects))
+
+    # Planning estimate of the similarity cost of a region with its best color.
+    def est_cost(self, rects):
+        return EST_SCALE * self.l2_cost(rects)
+
+# (n_blocks, n_blocks, 4) rectangles of the cells of an n_blocks grid over shape.
+def grid_rects(shape, n_blocks):
+    bx = shape[0] // n_blocks
+    by = shape[1] // n_blocks
+    x0, y0 = np.meshgrid(np.arange(n_blocks) * bx, np.arange(n_blocks) * by, indexing='ij')
+    return np.stack([x0, y0, x0 + bx, y0 + by], axis=-1)
@@ -1,13 +1,18 @@
 ### Simulator for the ISL.
 
 import argparse
+import csv
+import json
+import operator
 from PIL import Image
 import numpy as np
+import time
 
+import constants
 import lang
 import paint
 
-NCHAN = 4
+NCHAN = constants.NCHAN
 
 class ExecutionError(Exception):
     def __init__(self, msg, meta):
@@ -25,12 +30,20 @@ COLOR_COST = 5
 SWAP_COST = 3
 MERGE_COST = 1
 
+CHILD_TOKENS = ('0', '1', '2', '3')
+
 def compute_cost(base_cost, size, width, height):
     canvas_size = width * height
     return round(base_cost * canvas_size / size)
 
+# compute_cost over an array of block areas on a canvas of `canvas` pixels,
+# as floats. Empty blocks cost inf.
+def compute_costs(base_cost, area, canvas):
+    area = np.asarray(area)
+    return np.where(area > 0, np.round(base_cost * canvas / np.maximum(area, 1)), np.inf)
+
 def size(block):
-    return block.buf.shape[0] * block.buf.shape[1]
+    return block.w * block.h
 
 def make_filled_block(x, y, ex, ey, color):
     buf = np.zeros((ex-x, ey-y, NCHAN), dtype=np.uint8)
@@ -42,30 +55,290 @@ class Block:
         self.x = x
         self.y = y
         self.buf = buf
+    @property
+    def w(self):
+        return self.buf.shape[0]
+    @property
+    def h(self):
+        return self.buf.shape[1]
     def __str__(self):
         ex = self.x + self.buf.shape[0]
         ey = self.y + self.buf.shape[1]
         return f'({self.x},{self.y},{ex},{ey})'
     __repr__ = __str__
 
-class State:
-    def __init__(self, width, height, blocks):
+# Block that is only a rectangle over a shared canvas.
+class CanvasBlock:
+    def __init__(self, x, y, w, h):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+    def __str__(self):
+        return f'({self.x},{self.y},{self.x+self.w},{self.y+self.h})'
+    __repr__ = __str__
+
+# Interns block names as integer handles. Names form a trie: a cut hangs its
+# children off the parent's handle without building their names, a merge adds a
+# new root, and a name string is only put together when one is asked for. Moves
+# look their names up once, through a cache of the names seen so far. A handle
+# is recycled once its block is gone and no live block descends from it.
+class BlockTable:
+    def __init__(self):
+        self.blocks = [] # block by handle, None when there is no live block
+        self.parent = []
+        self.token = []
+        self.kids = [] # token -> handle, or None
+        self.cached = [] # name this handle is cached under, or None
+        self.roots = {}
+        self.cache = {}
+        self.free = []
+
+    def add(self, parent, token, block):
+        if self.free:
+            h = self.free.pop()
+            self.blocks[h] = block
+            self.parent[h] = parent
+            self.token[h] = token
+        else:
+            h = len(self.blocks)
+            self.blocks.append(block)
+            self.parent.append(parent)
+            self.token.append(token)
+            self.kids.append(None)
+            self.cached.append(None)
+        if parent < 0:
+            self.roots[token] = h
+        else:
+            if self.kids[parent] is None:
+                self.kids[parent] = {}
+            self.kids[parent][token] = h
+        return h
+
+    # Adds a block under a full (possibly dotted) name, for starting states.
+    def insert(self, name, block):
+        toks = name.split('.')
+        h = self.roots.get(toks[0])
+        if h is None:
+            h = self.add(-1, toks[0], None)
+        for tok in toks[1:]:
+            kids = self.kids[h]
+            nh = kids.get(tok) if kids is not None else None
+            h = nh if nh is not None else self.add(h, tok, None)
+        self.blocks[h] = block
+        return h
+
+    def lookup(self, name):
+        h = self.cache.get(name)
+        if h is not None:
+            return h
+        parent, dot, tok = name.rpartition('.')
+        if not dot:
+            h = self.roots.get(tok)
+        else:
+            # the parent was usually just named by the move that cut it
+            ph = self.lookup(parent)
+            kids = self.kids[ph] if ph is not None else None
+            h = kids.get(tok) if kids is not None else None
+        if h is not None:
+            self.cache[name] = h
+            self.cached[h] = name
+        return h
+
+    def name(self, h):
+        toks = []
+        while h >= 0:
+            toks.append(self.token[h])
+            h = self.parent[h]
+        return '.'.join(reversed(toks))
+
+    # The block at `h` was cut or merged away.
+    def remove(self, h):
+        self.blocks[h] = None
+        while h >= 0 and self.blocks[h] is None and not self.kids[h]:
+            parent = self.parent[h]
+            if parent < 0:
+                del self.roots[self.token[h]]
+            else:
+                del self.kids[parent][self.token[h]]
+            if self.cached[h] is not None:
+                del self.cache[self.cached[h]]
+                self.cached[h] = None
+            self.kids[h] = None
+            self.free.append(h)
+            h = parent
+
+    def items(self):
+        return ((h, b) for h, b in enumerate(self.blocks) if b is not None)
+
+    def values(self):
+        return (b for b in self.blocks if b is not None)
+
+MISSING = object()
+
+def restore_key(d, key, old):
+    if old is MISSING:
+        d.pop(key, None)
+    else:
+        d[key] = old
+
+# BlockTable that appends an undo entry, (fn, *args), to `journal` before each
+# change it makes. A state switches its table to this class while it has
+# checkpoints (see BaseState.checkpoint), so plain runs pay nothing for it.
+class JournaledBlockTable(BlockTable):
+    def add(self, parent, token, block):
+        j = self.journal
+        if self.free:
+            h = self.free.pop()
+            j.append((list.append, self.free, h))
+            for lst, v in ((self.blocks, block), (self.parent, parent), (self.token, token)):
+                j.append((operator.setitem, lst, h, lst[h]))
+                lst[h] = v
+        else:
+            h = len(self.blocks)
+            for lst, v in ((self.blocks, block), (self.parent, parent), (self.token, token),
+                           (self.kids, None), (self.cached, None)):
+                j.append((list.pop, lst))
+                lst.append(v)
+        if parent < 0:
+            d = self.roots
+        else:
+            if self.kids[parent] is None:
+                j.append((operator.setitem, self.kids, parent, None))
+                self.kids[parent] = {}
+            d = self.kids[parent]
+        j.append((restore_key, d, token, d.get(token, MISSING)))
+        d[token] = h
+        return h
+
+    def lookup(self, name):
+        h = self.cache.get(name)
+        if h is not None:
+            return h
+        parent, dot, tok = name.rpartition('.')
+        if not dot:
+            h = self.roots.get(tok)
+        else:
+            ph = self.lookup(parent)
+            kids = self.kids[ph] if ph is not None else None
+            h = kids.get(tok) if kids is not None else None
+        if h is not None:
+            self.journal.append((restore_key, self.cache, name, MISSING))
+            self.journal.append((operator.setitem, self.cached, h, self.cached[h]))
+            self.cache[name] = h
+            self.cached[h] = name
+        return h
+
+    def remove(self, h):
+        j = self.journal
+        j.append((operator.setitem, self.blocks, h, self.blocks[h]))
+        self.blocks[h] = None
+        while h >= 0 and self.blocks[h] is None and not self.kids[h]:
+            parent = self.parent[h]
+            d = self.roots if parent < 0 else self.kids[parent]
+            tok = self.token[h]
+            j.append((operator.setitem, d, tok, d[tok]))
+            del d[tok]
+            name = self.cached[h]
+            if name is not None:
+                j.append((operator.setitem, self.cache, name, self.cache[name]))
+                j.append((operator.setitem, self.cached, h, name))
+                del self.cache[name]
+                self.cached[h] = None
+            j.append((operator.setitem, self.kids, h, self.kids[h]))
+            self.kids[h] = None
+            j.append((list.pop, self.free))
+            self.free.append(h)
+            h = parent
+
+# Block bookkeeping, validation and costs shared by all backends. Subclasses
+# decide how pixels are stored by implementing paint_block, swap_blocks,
+# merge_blocks, sub_block, block_buf and render.
+class BaseState:
+    def __init__(self, width, height, blocks, *, ref=None):
         self.width = width
         self.height = height
-        self.blocks = blocks
-        self.gid = len(self.blocks) - 1
+        self.table = BlockTable()
+        for bid, block in blocks.items():
+            self.table.insert(bid, block)
+        self.gid = len(blocks) - 1
+        self.cost = 0
+        # pixel bytes written by the backend so far, for Profile
+        self.copied = 0
+        # moves applied so far, and (see track_provenance) which one set each
+        # pixel
+        self.applied = 0
+        self.owner = None
+        self.ref = None
+        if ref is not None:
+            self.track_ref(ref)
+
+    # Live blocks by ISL name. This builds every name, so the simulator itself
+    # only goes through the handle table.
+    @property
+    def blocks(self):
+        return {self.table.name(h): b for h, b in self.table.items()}
+
+    # Track the similarity cost against target image `ref` as moves are
+    # applied. Keeps the per-pixel distance to the target, so color and swap
+    # only recompute their own blocks, and cuts and merges only update the
+    # cached per-block costs. `sim_cost` is the running (unrounded) total.
+    # This is for searches that score after every move; a finished program is
+    # cheaper to score with one render() and paint.diff_cost.
+    def track_ref(self, ref):
+        self.ref = np.asarray(ref, dtype=np.float64)
+        self.dist = np.zeros((self.width, self.height))
+        for block in self.table.values():
+            self.dist[block.x:block.x+block.w, block.y:block.y+block.h] = (
+                self.pixel_dist(block, self.block_buf(block)))
+        self.sim_cost = paint.ALPHA * np.sum(self.dist)
+        self.block_sim = {}
+
+    # Keep the index (in applied moves) of the color move that last set each
+    # pixel, moved along by swaps. Pixels no color move has set since are -1.
+    def track_provenance(self):
+        self.owner = np.full((self.width, self.height), -1, dtype=np.int32)
+
+    def pixel_dist(self, block, pixels):
+        ref = self.ref[block.x:block.x+block.w, block.y:block.y+block.h]
+        return np.sqrt(np.sum((ref - pixels)**2, axis=-1))
 
-    def validate_block(self, block, *, meta):
-        if block not in self.blocks:
-            raise ExecutionError(f'Invalid block {move.block}', meta)
+    def update_sim(self, h, block, pixels):
+        region = self.dist[block.x:block.x+block.w, block.y:block.y+block.h]
+        old = np.sum(region)
+        region[:] = self.pixel_dist(block, pixels)
+        new = np.sum(region)
+        self.sim_cost += paint.ALPHA * (new - old)
+        self.block_sim[h] = paint.ALPHA * new
 
-    def validate_color(self, color):
+    def block_diff_cost(self, bid):
+        h = self.table.lookup(bid)
+        if h not in self.block_sim:
+            block = self.table.blocks[h]
+            self.block_sim[h] = paint.ALPHA * np.sum(
+                self.dist[block.x:block.x+block.w, block.y:block.y+block.h])
+        return self.block_sim[h]
+
+    # Execution cost so far plus rounded similarity cost, as sim.py reports it.
+    def total_cost(self):
+        return self.cost + round(self.sim_cost)
+
+    # Returns the handle of live block `block`. Errors take `move` rather than
+    # its meta, which is only built on failure.
+    def validate_block(self, block, *, move):
+        h = self.table.cache.get(block)
+        if h is None:
+            h = self.table.lookup(block)
+        if h is None or self.table.blocks[h] is None:
+            raise ExecutionError(f'Invalid block {block}', move.meta)
+        return h
+
+    def validate_color(self, color, *, move):
         if len(color) != NCHAN:
-            raise ExecutionError(f'Invalid color {color}', meta)
-        if not all(map(lambda x: isinstance(x, int), color)):
-            raise ExecutionError(f'Invalid color {color}', meta)
-        if not all(map(lambda x: 0 <= x <= 255, color)):
-            raise ExecutionError(f'Invalid color {color}', meta)
+            raise ExecutionError(f'Invalid color {color}', move.meta)
+        for x in color:
+            if type(x) is not int or not 0 <= x <= 255:
+                raise ExecutionError(f'Invalid color {color}', move.meta)
 
 
     def get_next_bid(self):
@@ -73,187 +346,685 @@ class State:
         return str(self.gid)
 
     def apply_color_move(self, move):
-        self.validate_block(move.block, meta=move.meta)
-        self.validate_color(move.color)
-        color = np.array(move.color, dtype=np.uint8)
-        block = self.blocks[move.block]
-        block.buf[:] = color
+        h = self.validate_block(move.block, move=move)
+        self.validate_color(move.color, move=move)
+        block = self.table.blocks[h]
+        self.paint_block(block, move.color)
+        if self.owner is not None:
+            self.owner[block.x:block.x+block.w, block.y:block.y+block.h] = self.applied
+        if self.ref is not None:
+            self.update_sim(h, block, np.array(move.color, dtype=np.float64))
         return compute_cost(COLOR_COST, size(block), self.width, self.height)
 
     def apply_swap_move(self, move):
-        self.validate_block(move.block1, meta=move.meta)
-        self.validate_block(move.block2, meta=move.meta)
-        b1 = self.blocks[move.block1]
-        b2 = self.blocks[move.block2]
-        if b1.buf.shape != b2.buf.shape:
+        h1 = self.validate_block(move.block1, move=move)
+        h2 = self.validate_block(move.block2, move=move)
+        b1 = self.table.blocks[h1]
+        b2 = self.table.blocks[h2]
+        if (b1.w, b1.h) != (b2.w, b2.h):
             raise ExecutionError(
-                f'Block shape mismatch {b1.buf.shape} vs {b2.buf.shape}',
+                f'Block shape mismatch {(b1.w, b1.h, NCHAN)} vs {(b2.w, b2.h, NCHAN)}',
                 move.meta)
-        self.blocks[move.block1].buf, self.blocks[move.block2].buf = (
-            self.blocks[move.block2].buf, self.blocks[move.block1].buf
-        )
+        self.swap_blocks(b1, b2)
+        if self.owner is not None:
+            o1 = self.owner[b1.x:b1.x+b1.w, b1.y:b1.y+b1.h]
+            o2 = self.owner[b2.x:b2.x+b2.w, b2.y:b2.y+b2.h]
+            o1[:], o2[:] = o2.copy(), o1.copy()
+        if self.ref is not None:
+            self.update_sim(h1, b1, self.block_buf(b1))
+            self.update_sim(h2, b2, self.block_buf(b2))
         # NOTE: See Discord messages... I don't know why this is size(b1)
         # instead of max(size(b1), size(b2)) like merge.
         return compute_cost(SWAP_COST, size(b1), self.width, self.height)
 
     def apply_merge_move(self, move):
-        self.validate_block(move.block1, meta=move.meta)
-        self.validate_block(move.block2, meta=move.meta)
-        b1 = self.blocks[move.block1]
-        b2 = self.blocks[move.block2]
+        h1 = self.validate_block(move.block1, move=move)
+        h2 = self.validate_block(move.block2, move=move)
+        b1 = self.table.blocks[h1]
+        b2 = self.table.blocks[h2]
         cost = compute_cost(MERGE_COST, max(size(b1), size(b2)), self.width, self.height)
         if b1.x != b2.x and b1.y != b2.y:
             raise ExecutionError(f'Block coords do not align', move.meta)
         new_block = None
         if b1.x == b2.x: # vertically stacked
-            if b1.buf.shape[0] != b2.buf.shape[0]:
+            if b1.w != b2.w:
                 raise ExecutionError(f'Block shapes do not align', move.meta)
-            if b1.y + b1.buf.shape[1] == b2.y:
-                b1.buf = np.concatenate((b1.buf, b2.buf), axis=1)
-                new_block = b1
-            elif b2.y + b2.buf.shape[1] == b1.y:
-                b2.buf = np.concatenate((b2.buf, b1.buf), axis=1)
-                new_block = b2
+            if b1.y + b1.h == b2.y:
+                new_block = self.merge_blocks(b1, b2, 1)
+            elif b2.y + b2.h == b1.y:
+                new_block = self.merge_blocks(b2, b1, 1)
             else:
                 raise ExecutionError(f'Blocks are not adjacent', move.meta)
         else: # horizontally stacked
             assert b1.y == b2.y
-            if b1.buf.shape[1] != b2.buf.shape[1]:
+            if b1.h != b2.h:
                 raise ExecutionError(f'Block shapes do not align', move.meta)
-            if b1.x + b1.buf.shape[0] == b2.x:
-                b1.buf = np.concatenate((b1.buf, b2.buf), axis=0)
-                new_block = b1
-            elif b2.x + b2.buf.shape[0] == b1.x:
-                b2.buf = np.concatenate((b2.buf, b1.buf), axis=0)
-                new_block = b2
+            if b1.x + b1.w == b2.x:
+                new_block = self.merge_blocks(b1, b2, 0)
+            elif b2.x + b2.w == b1.x:
+                new_block = self.merge_blocks(b2, b1, 0)
             else:
                 raise ExecutionError(f'Blocks are not adjacent', move.meta)
-        del self.blocks[move.block1]
-        del self.blocks[move.block2]
-        self.blocks[self.get_next_bid()] = new_block
+        self.table.remove(h1)
+        self.table.remove(h2)
+        h = self.table.add(-1, self.get_next_bid(), new_block)
+        if self.ref is not None:
+            self.merge_sim(h1, h2, h)
         return cost
 
+    def merge_sim(self, h1, h2, h):
+        s1 = self.block_sim.pop(h1, None)
+        s2 = self.block_sim.pop(h2, None)
+        if s1 is not None and s2 is not None:
+            self.block_sim[h] = s1 + s2
+
     def apply_line_cut_move(self, move):
-        self.validate_block(move.block, meta=move.meta)
-        block = self.blocks[move.block]
+        h = self.validate_block(move.block, move=move)
+        block = self.table.blocks[h]
         ori = move.orientation
         cost = compute_cost(LINE_CUT_COST, size(block), self.width, self.height)
         assert ori in ['x', 'y']
-        if ori == 'y' and (move.pos <= block.y or move.pos >= block.y + block.buf.shape[1]):
+        if ori == 'y' and (move.pos <= block.y or move.pos >= block.y + block.h):
             raise ExecutionError(
                 f'Line cut at {move.pos} out of bounds '
-                f'({block.y}, {block.y+block.buf.shape[1]})', move.meta)
-        if ori == 'x' and (move.pos <= block.x or move.pos >= block.x + block.buf.shape[0]):
+                f'({block.y}, {block.y+block.h})', move.meta)
+        if ori == 'x' and (move.pos <= block.x or move.pos >= block.x + block.w):
             raise ExecutionError(
                 f'Line cut at {move.pos} out of bounds '
-                f'({block.x}, {block.x+block.buf.shape[0]})', move.meta)
+                f'({block.x}, {block.x+block.w})', move.meta)
+        x, y, bw, bh = block.x, block.y, block.w, block.h
         if ori == 'y':
-            cut_ind = move.pos - block.y
-            buf1 = block.buf[:,:cut_ind]
-            buf2 = block.buf[:,cut_ind:]
-            b1 = Block(block.x, block.y, buf1)
-            b2 = Block(block.x, move.pos, buf2)
+            b1 = self.sub_block(block, x, y, bw, move.pos - y)
+            b2 = self.sub_block(block, x, move.pos, bw, y + bh - move.pos)
         elif ori == 'x':
-            cut_ind = move.pos - block.x
-            buf1 = block.buf[:cut_ind]
-            buf2 = block.buf[cut_ind:]
-            b1 = Block(block.x, block.y, buf1)
-            b2 = Block(move.pos, block.y, buf2)
+            b1 = self.sub_block(block, x, y, move.pos - x, bh)
+            b2 = self.sub_block(block, move.pos, y, x + bw - move.pos, bh)
         else:
             raise RuntimeError()
-        del self.blocks[move.block]
-        b1_name = move.block + '.0'
-        b2_name = move.block + '.1'
-        self.blocks[b1_name] = b1
-        self.blocks[b2_name] = b2
+        self.split_block(h, (b1, b2))
         return cost
 
     def apply_point_cut_move(self, move):
-        self.validate_block(move.block, meta=move.meta)
-        block = self.blocks[move.block]
+        h = self.validate_block(move.block, move=move)
+        block = self.table.blocks[h]
         cost = compute_cost(POINT_CUT_COST, size(block), self.width, self.height)
-        if (move.point[0] <= block.x or move.point[0] >= block.x + block.buf.shape[0] or
-            move.point[1] <= block.y or move.point[1] >= block.y + block.buf.shape[1]):
+        if (move.point[0] <= block.x or move.point[0] >= block.x + block.w or
+            move.point[1] <= block.y or move.point[1] >= block.y + block.h):
             raise ExecutionError(
                 f'Point cut at {move.point} out of bounds '
-                f'({block.x}, {block.x+block.buf.shape[0]}) x '
-                f'({block.y}, {block.y+block.buf.shape[1]})', move.meta)
-        cut_ind_x = move.point[0] - block.x
-        cut_ind_y = move.point[1] - block.y
-        buf1 = block.buf[:cut_ind_x,:cut_ind_y]
-        buf2 = block.buf[cut_ind_x:,:cut_ind_y]
-        buf3 = block.buf[cut_ind_x:,cut_ind_y:]
-        buf4 = block.buf[:cut_ind_x,cut_ind_y:]
-        b1 = Block(block.x, block.y, buf1)
-        b2 = Block(move.point[0], block.y, buf2)
-        b3 = Block(move.point[0], move.point[1], buf3)
-        b4 = Block(block.x, move.point[1], buf4)
-        del self.blocks[move.block]
-        b1_name = move.block + '.0'
-        b2_name = move.block + '.1'
-        b3_name = move.block + '.2'
-        b4_name = move.block + '.3'
-        self.blocks[b1_name] =  b1
-        self.blocks[b2_name] =  b2
-        self.blocks[b3_name] =  b3
-        self.blocks[b4_name] =  b4
+                f'({block.x}, {block.x+block.w}) x '
+                f'({block.y}, {block.y+block.h})', move.meta)
+        x, y, bw, bh = block.x, block.y, block.w, block.h
+        px, py = move.point
+        b1 = self.sub_block(block, x, y, px - x, py - y)
+        b2 = self.sub_block(block, px, y, x + bw - px, py - y)
+        b3 = self.sub_block(block, px, py, x + bw - px, y + bh - py)
+        b4 = self.sub_block(block, x, py, px - x, y + bh - py)
+        self.split_block(h, (b1, b2, b3, b4))
         return cost
 
+    # Replaces the block at handle `h` by its children `.0`, `.1`, ...
+    def split_block(self, h, children):
+        for tok, child in zip(CHILD_TOKENS, children):
+            self.table.add(h, tok, child)
+        self.table.remove(h)
+        if self.ref is not None:
+            self.block_sim.pop(h, None)
+
+    # Checkpoints for search: rollback(checkpoint()) undoes every move applied
+    # since, by replaying an undo journal of the block table changes, saved
+    # pixel regions and scalars, so both cost time in proportion to what the
+    # moves touched rather than to the canvas. Checkpoints nest; rolling back
+    # to one drops the ones taken after it, and the journal is kept until
+    # every checkpoint has been released.
+    def checkpoint(self):
+        if not isinstance(self, Journaled):
+            self.journal = []
+            self.checkpoints = []
+            self.table.journal = self.journal
+            self.table.__class__ = JournaledBlockTable
+            self.__class__ = journaled_class(type(self))
+        token = len(self.journal)
+        self.checkpoints.append(token)
+        return token
+
+    def rollback(self, token):
+        assert token in self.checkpoints, 'unknown or released checkpoint'
+        j = self.journal
+        while len(j) > token:
+            fn, *args = j.pop()
+            fn(*args)
+        while self.checkpoints[-1] > token:
+            self.checkpoints.pop()
+
+    def release(self, token):
+        self.checkpoints.remove(token)
+        if not self.checkpoints:
+            self.table.__class__ = BlockTable
+            self.__class__ = self.plain_class
+            del self.table.journal, self.journal, self.checkpoints
+
     def apply(self, move):
-        if isinstance(move, lang.ColorMove):
-            return self.apply_color_move(move)
-        elif isinstance(move, lang.SwapMove):
-            return self.apply_swap_move(move)
-        elif isinstance(move, lang.MergeMove):
-            return self.apply_merge_move(move)
-        elif isinstance(move, lang.LineCutMove):
-            return self.apply_line_cut_move(move)
-        elif isinstance(move, lang.PointCutMove):
-            return self.apply_point_cut_move(move)
-        else:
+        handler = APPLY_MOVE.get(type(move))
+        if handler is None:
             raise NotImplementedError()
+        cost = handler(self, move)
+        self.cost += cost
+        self.applied += 1
+        return cost
+
+APPLY_MOVE = {
+    lang.ColorMove: BaseState.apply_color_move,
+    lang.SwapMove: BaseState.apply_swap_move,
+    lang.MergeMove: BaseState.apply_merge_move,
+    lang.LineCutMove: BaseState.apply_line_cut_move,
+    lang.PointCutMove: BaseState.apply_point_cut_move,
+}
+
+# Every block owns (a view of) its own pixel buffer.
+class State(BaseState):
+    def paint_block(self, block, color):
+        block.buf[:] = np.array(color, dtype=np.uint8)
+        self.copied += block.buf.nbytes
+
+    def swap_blocks(self, b1, b2):
+        b1.buf, b2.buf = b2.buf, b1.buf
+
+    # `lo` is the block with the smaller coordinate along `axis`
+    def merge_blocks(self, lo, hi, axis):
+        self.copied += lo.buf.nbytes + hi.buf.nbytes
+        return Block(lo.x, lo.y, np.concatenate((lo.buf, hi.buf), axis=axis))
+
+    def sub_block(self, block, x, y, w, h):
+        ix, iy = x - block.x, y - block.y
+        return Block(x, y, block.buf[ix:ix+w, iy:iy+h])
+
+    # undo entries for a color or swap on `block` (see BaseState.checkpoint)
+    def journal_block(self, j, block):
+        j.append((setattr, block, 'buf', block.buf))
+        j.append((np.copyto, block.buf, block.buf.copy()))
+
+    def block_buf(self, block):
+        return block.buf
 
     def render(self):
         canvas = np.zeros((self.width, self.height, NCHAN), dtype=np.uint8)
-        for block in self.blocks.values():
+        for block in self.table.values():
             x, y = block.x, block.y
             wx, wy = block.buf.shape[:2]
             assert x >= 0 and y >= 0 and x+wx <= self.width and y+wy <= self.height
             canvas[x:x+wx, y:y+wy] = block.buf
         return canvas
 
-def run_program(state, moves):
-    tot_cost = 0
-    for move in moves:
+def pack_color(color):
+    return np.array(color, dtype=np.uint8).view(np.uint32)[0]
+
+# All blocks are rectangles over one shared canvas, so cuts and merges never
+# touch pixel data and only color and swap write to the canvas. Takes the same
+# starting blocks as State.
+class CanvasState(BaseState):
+    def __init__(self, width, height, blocks, *, ref=None):
+        self.canvas = np.zeros((width, height, NCHAN), dtype=np.uint8)
+        # one uint32 per pixel, so fills and copies move whole pixels
+        self.pixels = self.canvas.view(np.uint32).reshape(width, height)
+        rects = {}
+        for bid, block in blocks.items():
+            x, y = block.x, block.y
+            wx, wy = block.buf.shape[:2]
+            assert x >= 0 and y >= 0 and x+wx <= width and y+wy <= height
+            self.canvas[x:x+wx, y:y+wy] = block.buf
+            rects[bid] = CanvasBlock(x, y, wx, wy)
+        super().__init__(width, height, rects, ref=ref)
+
+    def region(self, block):
+        return self.pixels[block.x:block.x+block.w, block.y:block.y+block.h]
+
+    def paint_block(self, block, color):
+        self.region(block)[:] = pack_color(color)
+        self.copied += NCHAN * block.w * block.h
+
+    def swap_blocks(self, b1, b2):
+        tmp = self.region(b1).copy()
+        self.region(b1)[:] = self.region(b2)
+        self.region(b2)[:] = tmp
+        self.copied += 3 * NCHAN * b1.w * b1.h
+
+    def merge_blocks(self, lo, hi, axis):
+        if axis == 0:
+            return CanvasBlock(lo.x, lo.y, lo.w + hi.w, lo.h)
+        return CanvasBlock(lo.x, lo.y, lo.w, lo.h + hi.h)
+
+    def sub_block(self, block, x, y, w, h):
+        return CanvasBlock(x, y, w, h)
+
+    def journal_block(self, j, block):
+        region = self.region(block)
+        j.append((np.copyto, region, region.copy()))
+
+    def block_buf(self, block):
+        return self.canvas[block.x:block.x+block.w, block.y:block.y+block.h]
+
+    # NOTE: this is the live canvas, copy it before running more moves if the
+    # image needs to be kept.
+    def render(self):
+        return self.canvas
+
+# Contents of a symbolic block, read clipped to the rect of the block that owns
+# it. Nodes are shared between blocks and never modified, so every move is O(1):
+#   ('fill', color)              uniform color everywhere
+#   ('image', x, y, buf)         pixels of a starting block placed at (x, y)
+#   ('join', r1, n1, r2, n2)     n1 inside rect r1 and n2 inside rect r2
+#   ('shift', dx, dy, n)         n moved by (dx, dy)
+class SymbolicBlock(CanvasBlock):
+    def __init__(self, x, y, w, h, node):
+        super().__init__(x, y, w, h)
+        self.node = node
+
+def intersect(r1, r2):
+    x = max(r1[0], r2[0])
+    y = max(r1[1], r2[1])
+    ex = min(r1[0] + r1[2], r2[0] + r2[2])
+    ey = min(r1[1] + r1[3], r2[1] + r2[3])
+    if ex <= x or ey <= y: return None
+    return (x, y, ex - x, ey - y)
+
+# Yields the (x, y, w, h) pieces of `node` inside `rect` along with their color,
+# or their pixel buffer for pieces of a non-uniform starting block.
+def iter_pieces(node, rect):
+    stack = [(node, rect, 0, 0)]
+    while stack:
+        node, clip, dx, dy = stack.pop()
+        kind = node[0]
+        if kind == 'fill':
+            yield clip, node[1]
+        elif kind == 'join':
+            for r, n in ((node[1], node[2]), (node[3], node[4])):
+                sub = intersect(clip, (r[0] + dx, r[1] + dy, r[2], r[3]))
+                if sub is not None:
+                    stack.append((n, sub, dx, dy))
+        elif kind == 'shift':
+            stack.append((node[3], clip, dx + node[1], dy + node[2]))
+        elif kind == 'image':
+            x, y, w, h = clip
+            ix, iy = x - dx - node[1], y - dy - node[2]
+            yield clip, node[3][ix:ix+w, iy:iy+h]
+        else:
+            raise RuntimeError()
+
+# Blocks are rectangles plus a piece tree, so the program can be validated and
+# costed without touching pixels. Pixels are only produced by render().
+class SymbolicState(BaseState):
+    def __init__(self, width, height, blocks, *, ref=None):
+        rects = {}
+        for bid, block in blocks.items():
+            buf = block.buf
+            wx, wy = buf.shape[:2]
+            if np.all(buf == buf[0,0]):
+                node = ('fill', tuple(int(c) for c in buf[0,0]))
+            else:
+                node = ('image', block.x, block.y, buf.copy())
+            rects[bid] = SymbolicBlock(block.x, block.y, wx, wy, node)
+        super().__init__(width, height, rects, ref=ref)
+
+    @staticmethod
+    def from_state(state):
+        blocks = {
+            bid: Block(b.x, b.y, state.block_buf(b))
+            for bid, b in state.blocks.items()
+        }
+        out = SymbolicState(state.width, state.height, blocks, ref=state.ref)
+        out.gid = state.gid
+        out.cost = state.cost
+        return out
+
+    def paint_block(self, block, color):
+        block.node = ('fill', tuple(color))
+
+    def swap_blocks(self, b1, b2):
+        n1, n2 = b1.node, b2.node
+        if n2[0] != 'fill':
+            n2 = ('shift', b1.x - b2.x, b1.y - b2.y, n2)
+        if n1[0] != 'fill':
+            n1 = ('shift', b2.x - b1.x, b2.y - b1.y, n1)
+        b1.node, b2.node = n2, n1
+
+    def merge_blocks(self, lo, hi, axis):
+        if axis == 0:
+            w, h = lo.w + hi.w, lo.h
+        else:
+            w, h = lo.w, lo.h + hi.h
+        if lo.node[0] == 'fill' and hi.node[0] == 'fill' and lo.node[1] == hi.node[1]:
+            node = lo.node
+        else:
+            node = ('join', (lo.x, lo.y, lo.w, lo.h), lo.node,
+                    (hi.x, hi.y, hi.w, hi.h), hi.node)
+        return SymbolicBlock(lo.x, lo.y, w, h, node)
+
+    def sub_block(self, block, x, y, w, h):
+        return SymbolicBlock(x, y, w, h, block.node)
+
+    def journal_block(self, j, block):
+        j.append((setattr, block, 'node', block.node))
+
+    # (x, y, w, h) pieces making up the block, with their colors
+    def block_pieces(self, block):
+        return iter_pieces(block.node, (block.x, block.y, block.w, block.h))
+
+    def block_buf(self, block):
+        buf = np.zeros((block.w, block.h, NCHAN), dtype=np.uint8)
+        self.rasterize(block, buf.view(np.uint32).reshape(block.w, block.h), block.x, block.y)
+        return buf
+
+    def rasterize(self, block, out, ox, oy):
+        for (x, y, w, h), val in self.block_pieces(block):
+            if isinstance(val, np.ndarray):
+                val = val.view(np.uint32).reshape(w, h)
+            else:
+                val = pack_color(val)
+            out[x-ox:x-ox+w, y-oy:y-oy+h] = val
+            self.copied += NCHAN * w * h
+
+    def render(self):
+        canvas = np.zeros((self.width, self.height, NCHAN), dtype=np.uint8)
+        pixels = canvas.view(np.uint32).reshape(self.width, self.height)
+        for block in self.table.values():
+            self.rasterize(block, pixels, 0, 0)
+        return canvas
+
+BACKENDS = {
+    'blocks': State,
+    'canvas': CanvasState,
+    'symbolic': SymbolicState,
+}
+
+# Journaling versions of the state methods that change anything outside the
+# block table, used while a state has checkpoints. Every move first saves the
+# scalars and the pixels of the blocks it may paint or swap.
+class Journaled:
+    def apply(self, move):
+        j = self.journal
+        saved = {'gid': self.gid, 'cost': self.cost, 'copied': self.copied,
+                 'applied': self.applied}
+        if self.ref is not None:
+            saved['sim_cost'] = self.sim_cost
+        j.append((self.__dict__.update, saved))
+        if isinstance(move, lang.ColorMove):
+            names = (move.block,)
+        elif isinstance(move, lang.SwapMove):
+            names = (move.block1, move.block2)
+        else:
+            names = ()
+        for name in names:
+            h = self.table.lookup(name)
+            if h is not None and self.table.blocks[h] is not None:
+                b = self.table.blocks[h]
+                self.journal_block(j, b)
+                if self.owner is not None:
+                    region = self.owner[b.x:b.x+b.w, b.y:b.y+b.h]
+                    j.append((np.copyto, region, region.copy()))
+        return super().apply(move)
+
+    def journal_sim(self, *hs):
+        for h in hs:
+            self.journal.append((restore_key, self.block_sim, h, self.block_sim.get(h, MISSING)))
+
+    def update_sim(self, h, block, pixels):
+        region = self.dist[block.x:block.x+block.w, block.y:block.y+block.h]
+        self.journal.append((np.copyto, region, region.copy()))
+        self.journal_sim(h)
+        super().update_sim(h, block, pixels)
+
+    def block_diff_cost(self, bid):
+        self.journal_sim(self.table.lookup(bid))
+        return super().block_diff_cost(bid)
+
+    def merge_sim(self, h1, h2, h):
+        self.journal_sim(h1, h2, h)
+        super().merge_sim(h1, h2, h)
+
+    def split_block(self, h, children):
+        if self.ref is not None:
+            self.journal_sim(h)
+        super().split_block(h, children)
+
+JOURNALED = {}
+
+def journaled_class(cls):
+    if cls not in JOURNALED:
+        JOURNALED[cls] = type('Journaled' + cls.__name__, (Journaled, cls),
+                              {'plain_class': cls})
+    return JOURNALED[cls]
+
+# The standard blank 400x400 white starting canvas.
+def blank_state(*, backend='canvas', ref=None):
+    return BACKENDS[backend](400, 400, {
+        '0': make_filled_block(0, 0, 400, 400, (255,255,255,255))
+    }, ref=ref)
+
+# Per move timing and cost attribution for run_program(..., profile=Profile()).
+# Every move gets a row of FIELDS: its index in the program, source line
+# (the index when the move has none), type, wall-clock seconds, execution
+# cost, change in similarity cost (0 without a ref) and pixel bytes written.
+# A move's score cost is its execution cost plus its similarity change.
+class Profile:
+    FIELDS = ('index', 'lineno', 'kind', 'time', 'cost', 'sim_delta', 'bytes')
+    KINDS = {
+        lang.ColorMove: 'color',
+        lang.SwapMove: 'swap',
+        lang.MergeMove: 'merge',
+        lang.LineCutMove: 'line_cut',
+        lang.PointCutMove: 'point_cut',
+    }
+
+    def __init__(self):
+        self.rows = []
+        self.moves = []
+        self.render_time = 0.0
+
+    def apply(self, state, move):
+        tracked = state.ref is not None
+        sim0 = state.sim_cost if tracked else 0.0
+        copied0 = state.copied
+        start = time.perf_counter()
         cost = state.apply(move)
-        tot_cost += cost
-    return {
-        'output': state.render(),
-        'cost': tot_cost
+        elapsed = time.perf_counter() - start
+        i = len(self.rows)
+        lineno = move.lineno if move.lineno is not None else i + 1
+        self.rows.append((i, lineno, self.KINDS.get(type(move), type(move).__name__),
+                          elapsed, cost, (state.sim_cost - sim0) if tracked else 0.0,
+                          state.copied - copied0))
+        self.moves.append(move)
+        return cost
+
+    def render(self, state):
+        start = time.perf_counter()
+        out = state.render()
+        self.render_time += time.perf_counter() - start
+        return out
+
+    # Totals of count, time, cost, sim_delta and bytes by move type.
+    def by_kind(self):
+        out = {}
+        for _, _, kind, t, cost, sim_delta, nbytes in self.rows:
+            tot = out.setdefault(kind, {'count': 0, 'time': 0.0, 'cost': 0,
+                                        'sim_delta': 0.0, 'bytes': 0})
+            tot['count'] += 1
+            tot['time'] += t
+            tot['cost'] += cost
+            tot['sim_delta'] += sim_delta
+            tot['bytes'] += nbytes
+        return out
+
+    # Rows of the n moves with the largest score cost ('score') or any field.
+    def top(self, n, key='score'):
+        if key == 'score':
+            f = lambda r: r[4] + r[5]
+        else:
+            f = lambda r, k=self.FIELDS.index(key): r[k]
+        return sorted(self.rows, key=f, reverse=True)[:n]
+
+    def line(self, row):
+        return lang.format_move(self.moves[row[0]])
+
+    def report(self, n=10):
+        out = [f'{"move":>10} {"count":>8} {"time ms":>10} {"cost":>10} '
+               f'{"sim delta":>12} {"MB copied":>10}']
+        for kind, tot in sorted(self.by_kind().items()):
+            out.append(f'{kind:>10} {tot["count"]:>8} {tot["time"]*1e3:>10.2f} '
+                       f'{tot["cost"]:>10} {tot["sim_delta"]:>12.1f} '
+                       f'{tot["bytes"]/2**20:>10.2f}')
+        out.append(f'render: {self.render_time*1e3:.2f}ms')
+        for title, key in [('score cost', 'score'), ('simulation time', 'time')]:
+            out.append(f'top {n} lines by {title}:')
+            for row in self.top(n, key):
+                out.append(f'  line {row[1]:>6}: {row[3]*1e3:8.3f}ms, cost {row[4]:>5}, '
+                           f'sim {row[5]:+10.1f}  {self.line(row)}')
+        return '\n'.join(out)
+
+    def save(self, fname):
+        with open(fname, 'w', newline='') as f:
+            if fname.endswith('.csv'):
+                w = csv.writer(f)
+                w.writerow(self.FIELDS + ('line',))
+                w.writerows(row + (self.line(row),) for row in self.rows)
+            else:
+                json.dump({
+                    'by_kind': self.by_kind(),
+                    'render_time': self.render_time,
+                    'moves': [dict(zip(self.FIELDS, row), line=self.line(row))
+                              for row in self.rows],
+                }, f)
+
+# A starting state from a problem's initial state JSON: its canvas size and
+# filled blocks, {"width", "height", "blocks": [{"blockId", "bottomLeft",
+# "topRight", "color"}]}.
+def load_state(fname, *, backend='canvas', ref=None):
+    with open(fname) as f:
+        data = json.load(f)
+    blocks = {}
+    for block in data['blocks']:
+        x, y = block['bottomLeft']
+        ex, ey = block['topRight']
+        blocks[block['blockId']] = make_filled_block(x, y, ex, ey, tuple(block['color']))
+    return BACKENDS[backend](data.get('width', 400), data.get('height', 400), blocks, ref=ref)
+
+# With mode='symbolic' the moves run on a SymbolicState copy of `state` (unless
+# it already is one), and the image is only rasterized if `render` is set.
+# Passing a Profile times and attributes every move (and the render) to it; the
+# plain loop is untouched otherwise. With `provenance` the result also has
+# 'provenance', the index in `moves` of the color move behind every final
+# pixel (-1 for pixels of the starting state).
+def run_program(state, moves, *, mode='raster', render=True, profile=None, provenance=False):
+    if mode == 'symbolic' and not isinstance(state, SymbolicState):
+        state = SymbolicState.from_state(state)
+    if provenance:
+        state.track_provenance()
+        state.applied = 0
+    tot_cost = 0
+    if profile is not None:
+        for move in moves:
+            tot_cost += profile.apply(state, move)
+        output = profile.render(state) if render else None
+    else:
+        for move in moves:
+            cost = state.apply(move)
+            tot_cost += cost
+        output = state.render() if render else None
+    res = {
+        'output': output,
+        'cost': tot_cost,
+        'state': state,
     }
+    if provenance:
+        res['provenance'] = state.owner
+    return res
 
+# Replays a compiled program (see lang.compile_moves) without any parsing.
+def run_compiled(state, prog, **kwargs):
+    return run_program(state, lang.iter_compiled(prog), **kwargs)
+
+# Applies `moves` to a state that tracks `ref` and checks the tracked costs
+# against a full render() + paint.diff_cost after every move.
+def check_tracked_cost(state, moves, ref):
+    exec_cost = state.cost
+    for move in moves:
+        exec_cost += state.apply(move)
+        diff_cost = paint.diff_cost(ref, state.render())
+        if (state.cost != exec_cost or
+            abs(state.sim_cost - diff_cost) > 1e-6 * max(1.0, diff_cost)):
+            raise AssertionError(
+                f'Tracked cost {state.cost} + {state.sim_cost} does not match '
+                f'{exec_cost} + {diff_cost}\nIn line {move.meta["lineno"]}:\n'
+                f'{move.meta["line"]}')
+        for bid in state.blocks:
+            block = state.blocks[bid]
+            direct = paint.diff_cost(
+                ref[block.x:block.x+block.w, block.y:block.y+block.h],
+                state.block_buf(block))
+            if abs(state.block_diff_cost(bid) - direct) > 1e-6 * max(1.0, direct):
+                raise AssertionError(f'Tracked cost of block {bid} is off')
+    return state.total_cost()
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--fname', type=str, required=True)
     parser.add_argument('--out_fname', type=str, default='tmp.png')
     parser.add_argument('--ref', type=str, default=None)
+    parser.add_argument('--initial_state', type=str, default=None,
+                        help='initial state JSON to start from instead of a blank canvas')
+    parser.add_argument('--backend', type=str, default='canvas', choices=BACKENDS.keys())
+    parser.add_argument('--cost-only', action='store_true',
+                        help='validate and cost symbolically, only rasterize for --ref')
+    parser.add_argument('--verify', action='store_true',
+                        help='check the tracked diff cost against a full render after every move')
+    parser.add_argument('--compiled', action='store_true',
+                        help='replay from the compiled .npz sidecar, (re)building it if stale')
+    parser.add_argument('--profile', action='store_true',
+                        help='time and cost every move, and report by move type and line')
+    parser.add_argument('--top', type=int, default=10,
+                        help='lines to list in the --profile report')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='write the --profile per move trace here (.json or .csv)')
+    parser.add_argument('--provenance', type=str, default=None,
+                        help='save the index of the color move behind every pixel here (.npy)')
     args = parser.parse_args()
+    profile = Profile() if args.profile or args.trace else None
 
-    with open(args.fname, 'r') as f:
-        moves =  lang.parse_program(f.read())
+    ref = paint.load_mapped(args.ref) if args.ref is not None else None
+    backend = 'symbolic' if args.cost_only else args.backend
+    # tracking the similarity cost per move is slower than one diff of the
+    # final image, so only --verify and the --profile similarity column use it
+    track = ref if args.verify or profile is not None else None
+    if args.initial_state is not None:
+        state = load_state(args.initial_state, backend=backend, ref=track)
+    else:
+        state = blank_state(backend=backend, ref=track)
 
-    # basic starting state
-    # TODO: advanced starting states
-    state = State(400, 400, {
-        '0': make_filled_block(0, 0, 400, 400, (255,255,255,255))
-    })
+    with open(args.fname, 'r') as f:
+        if args.compiled or args.fname.endswith('.npz'):
+            moves = lang.iter_compiled(lang.load_program(args.fname))
+        else:
+            moves = lang.iter_program(f)
+        if args.verify:
+            assert ref is not None, '--verify needs --ref'
+            print('Verified total cost:', check_tracked_cost(state, moves, ref))
+            return
+        if args.cost_only:
+            res = run_program(state, moves, mode='symbolic', render=ref is not None,
+                              profile=profile, provenance=args.provenance is not None)
+        else:
+            res = run_program(state, moves, profile=profile,
+                              provenance=args.provenance is not None)
+            paint.save(res['output'], args.out_fname)
 
-    res = run_program(state, moves)
-    paint.save(res['output'], args.out_fname)
+    if args.provenance is not None:
+        np.save(args.provenance, res['provenance'])
+    if profile is not None:
+        print(profile.report(args.top))
+        if args.trace is not None:
+            profile.save(args.trace)
 
-    if args.ref is not None:
-        ref = paint.load(args.ref)
+    if ref is not None:
         diff_cost = round(paint.diff_cost(ref, res['output']))
     else:
         print('WARNING: No ref specified, skipping diff cost')
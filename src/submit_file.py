@@ -2,12 +2,17 @@
 
 import api
 import argparse
+import lang
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--fname',  type=str, required=True)
     parser.add_argument('--num', type=int, required=True)
     args = parser.parse_args()
-    print(api.submit_file(args.fname, num=args.num))
+    if args.fname.endswith('.npz'):
+        isl = lang.format_program(lang.iter_compiled(lang.load_compiled(args.fname)))
+        print(api.submit_str(isl, num=args.num))
+    else:
+        print(api.submit_file(args.fname, num=args.num))
 
 if __name__ == '__main__': main()
@@ -3,10 +3,21 @@ import sim
 import json
 from collections import defaultdict
 
+import numpy as np
+import scipy as sp
+import scipy.optimize
+
+import lang
 import paint
 
 
-# greedily selects swaps repeatedly
+# Blocks of each shape are matched to positions with an optimal assignment over
+# a pairwise similarity cost matrix, and the assignment is executed as swap
+# cycles. The old greedy pass is replayed on the same matrices and used instead
+# whenever it comes out cheaper.
+
+# keeps the color x position cost chunks around this many float64s
+CHUNK_ELEMS = 1 << 22
 
 
 def main():
@@ -24,64 +35,131 @@ def main():
     # 'bottomLeft': [0, 0], 'topRight': [40, 40]
 
     blocks_map = {}
-    has_been_swapped = defaultdict(bool)
-    img = paint.load(args.input)
+    img = paint.load_mapped(args.input)
 
     for block in blocks_json:
         x, y = block['bottomLeft']
         ex, ey = block['topRight']
         blocks_map[block['blockId']] = sim.make_filled_block(x, y, ex, ey, tuple(block['color']))
 
-    cmds = []
-    for block_id in blocks_map.keys():
-        cmds.extend(find_best_swap(blocks_map, has_been_swapped, block_id, img))
+    cmds, benefit = solve_swaps(blocks_map, img)
+    paint.eprint(f'{len(cmds)} swaps, saving {benefit:.1f}')
 
     print('\n'.join(cmds))
-    
+
 
 def determine_move_cost(width, height):
     return round(3 * (400 * 400) / (width * height))
-    
-
-
-# brute force solution
-# just swaps whenever it is better than starting state.
-def find_best_swap(blocks_map, has_been_swapped, block_id, img):
-    to_swap_block = blocks_map[block_id]
-    to_swap_block_width = to_swap_block.buf.shape[0]
-    to_swap_block_height = to_swap_block.buf.shape[1]
-    to_swap_img_section = img[to_swap_block.x:to_swap_block.x + to_swap_block_width,
-                              to_swap_block.y:to_swap_block.y + to_swap_block_height]
 
-    cur_to_cost = paint.diff_cost(to_swap_block.buf, to_swap_img_section)
 
-    move_cost = determine_move_cost(*to_swap_block.buf.shape[:2])
-    
-    for swap_block_id in blocks_map.keys():
-        if has_been_swapped[swap_block_id]:
+# Block ids grouped by (w, h), each group in blocks_map order.
+def shape_groups(blocks_map):
+    groups = defaultdict(list)
+    for block_id, block in blocks_map.items():
+        groups[(block.w, block.h)].append(block_id)
+    return groups
+
+# D[i, j] = similarity cost of painting block i's color over block j's area of
+# `img`, for every pair in a group of same-shape filled blocks. Squared
+# distances are expanded as |p|^2 - 2 p.c + |c|^2 so the bulk of the work is
+# one matmul per chunk; every term is an integer, so this is exact in float64.
+def pairwise_costs(blocks, img):
+    w, h = blocks[0].w, blocks[0].h
+    pixels = np.stack([img[b.x:b.x+w, b.y:b.y+h].reshape(-1, paint.NCHAN)
+                       for b in blocks]).astype(np.float64).reshape(-1, paint.NCHAN)
+    colors = np.array([b.buf[0, 0] for b in blocks], dtype=np.float64)
+    uniq, inverse = np.unique(colors, axis=0, return_inverse=True)
+    sq_pixels = np.sum(pixels**2, axis=-1)
+    sq_colors = np.sum(uniq**2, axis=-1)
+    D = np.empty((len(uniq), len(blocks)))
+    step = max(1, CHUNK_ELEMS // len(pixels))
+    for start in range(0, len(uniq), step):
+        c = uniq[start:start+step]
+        d2 = sq_pixels[None, :] + sq_colors[start:start+step, None] - 2 * (c @ pixels.T)
+        dist = np.sqrt(d2).reshape(len(c), len(blocks), w*h)
+        D[start:start+step] = paint.ALPHA * np.sum(dist, axis=-1)
+    return D[inverse.reshape(-1)]
+
+# The swaps find_best_swap used to pick, replayed on the cost matrix: each
+# block in turn swaps with the first not-yet-swapped block whose (stale, never
+# updated) benefit beats the move cost. Returns index pairs.
+def greedy_swaps(D, move_cost):
+    n = len(D)
+    diag = np.diag(D)
+    swapped = np.zeros(n, dtype=bool)
+    pairs = []
+    for i in range(n):
+        benefit = (diag[i] - D[:, i]) + (diag - D[i, :])
+        ok = np.flatnonzero((benefit > move_cost) & ~swapped)
+        if len(ok):
+            j = ok[0]
+            swapped[i] = swapped[j] = True
+            pairs.append((i, int(j)))
+    return pairs
+
+# Optimal assignment of colors to positions, split into cycles. A cycle of
+# length L takes L-1 swaps and is only kept if it pays for them.
+def assignment_swaps(D, move_cost):
+    n = len(D)
+    C = D + move_cost * (1 - np.eye(n))
+    rows, cols = sp.optimize.linear_sum_assignment(C)
+    dest = np.empty(n, dtype=int)
+    dest[rows] = cols
+    seen = np.zeros(n, dtype=bool)
+    pairs = []
+    for i in range(n):
+        if seen[i]:
             continue
-        from_swap_block = blocks_map[swap_block_id]
-        from_swap_block_width = from_swap_block.buf.shape[0]
-        from_swap_block_height = from_swap_block.buf.shape[1]
-        from_swap_img_section = img[from_swap_block.x:from_swap_block.x + from_swap_block_width,
-                                  from_swap_block.y:from_swap_block.y + from_swap_block_height]
-
-        cur_from_cost = paint.diff_cost(from_swap_block.buf, from_swap_img_section)
+        cycle = [i]
+        seen[i] = True
+        j = dest[i]
+        while j != i:
+            cycle.append(j)
+            seen[j] = True
+            j = dest[j]
+        if len(cycle) == 1:
+            continue
+        benefit = sum(D[k, k] - D[k, dest[k]] for k in cycle)
+        if benefit > (len(cycle) - 1) * move_cost:
+            # swapping i with each later member in turn moves every color one
+            # step along the cycle
+            pairs.extend((i, int(k)) for k in cycle[1:])
+    return pairs
+
+# Similarity saved by applying `pairs` (as swaps, in order), minus their cost.
+def swap_benefit(D, pairs, move_cost):
+    content = np.arange(len(D))
+    for i, j in pairs:
+        content[i], content[j] = content[j], content[i]
+    pos = np.arange(len(D))
+    return np.sum(np.diag(D)) - np.sum(D[content, pos]) - len(pairs) * move_cost
+
+# lang swap moves (and their net benefit) for the better of the assignment and
+# greedy plans in every shape group.
+def solve_swap_moves(blocks_map, img):
+    moves = []
+    total = 0.0
+    for (w, h), ids in shape_groups(blocks_map).items():
+        if len(ids) < 2:
+            continue
+        D = pairwise_costs([blocks_map[b] for b in ids], img)
+        move_cost = determine_move_cost(w, h)
+        plans = [assignment_swaps(D, move_cost), greedy_swaps(D, move_cost)]
+        benefits = [swap_benefit(D, p, move_cost) for p in plans]
+        best = int(np.argmax(benefits))
+        if benefits[best] <= 0:
+            continue
+        total += benefits[best]
+        moves.extend(lang.SwapMove(ids[i], ids[j]) for i, j in plans[best])
+    return moves, total
 
-        swapped_from_cost = paint.diff_cost(to_swap_block.buf, from_swap_img_section)
-        swapped_to_cost = paint.diff_cost(from_swap_block.buf, to_swap_img_section)
+# solve_swap_moves as swap commands.
+def solve_swaps(blocks_map, img):
+    moves, total = solve_swap_moves(blocks_map, img)
+    return [lang.format_move(m) for m in moves], total
 
-        benefit = (cur_to_cost - swapped_to_cost) + (cur_from_cost - swapped_from_cost)
 
-        if benefit > move_cost:
-            has_been_swapped[block_id] = True
-            has_been_swapped[swap_block_id] = True
-            return [f"swap [{block_id}] [{swap_block_id}]"]
 
-    return []
-    
-    
-    
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,162 @@
+# Local parameter sweep over cheap_grid configs using a process pool (no ray).
+# The reference image lives in shared memory; each worker solves the colors for
+# a num_blocks once and reuses them for every orient/bleed variant it scores.
+import argparse
+import concurrent.futures
+import itertools
+import math
+import numpy as np
+import os
+import random
+import time
+from multiprocessing import shared_memory
+
+import paint
+import regions
+import sim
+
+NUM_BLOCKS = [1, 2, 4, 5, 8, 10, 16, 20, 25]
+ORIENTS = ['vertA', 'vertB', 'horizA', 'horizB']
+MAX_BLEED = 14
+
+# successive halving scores similarity on every stride'th pixel, finest last
+HALVING_STRIDES = (8, 4, 2, 1)
+
+# per worker state
+IMG = None
+SHM = None
+STATS = None
+COLORS = {}
+
+def init_worker(shm_name, shape, dtype, use_cache):
+    global IMG, SHM, STATS
+    if not use_cache:
+        paint.COLOR_CACHE = None
+    SHM = shared_memory.SharedMemory(name=shm_name)
+    IMG = np.ndarray(shape, dtype=dtype, buffer=SHM.buf)
+    STATS = regions.RegionStats(IMG)
+
+def grid_colors(n):
+    if n not in COLORS:
+        COLORS[n], _, _ = paint.grid_colors(IMG, n, stats=STATS)
+    return COLORS[n]
+
+def score_config(config, stride):
+    color_blocks = grid_colors(config['num_blocks'])
+    moves = paint.grid_moves(IMG.shape, color_blocks, config['orient'],
+                             (config['bleed_a'], config['bleed_b']))
+    res = sim.run_program(sim.blank_state(), moves)
+    if stride == 1:
+        diff_cost = paint.diff_cost(IMG, res['output'])
+    else:
+        diff_cost = stride * stride * paint.diff_cost(
+            IMG[::stride, ::stride], res['output'][::stride, ::stride])
+    return res['cost'] + round(diff_cost)
+
+def score_chunk(configs, stride):
+    return [score_config(c, stride) for c in configs]
+
+def make_config(n, orient, bleed_a, bleed_b):
+    return {'num_blocks': n, 'orient': orient, 'bleed_a': bleed_a, 'bleed_b': bleed_b}
+
+def grid_space():
+    bleeds = range(MAX_BLEED)
+    return [make_config(*c) for c in itertools.product(NUM_BLOCKS, ORIENTS, bleeds, bleeds)]
+
+def random_space(num_samples, rng):
+    space = grid_space()
+    return rng.sample(space, min(num_samples, len(space)))
+
+class Sweeper:
+    def __init__(self, img, jobs, *, use_cache=True):
+        self.jobs = jobs
+        self.shm = shared_memory.SharedMemory(create=True, size=img.nbytes)
+        np.ndarray(img.shape, dtype=img.dtype, buffer=self.shm.buf)[:] = img
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_worker,
+            initargs=(self.shm.name, img.shape, img.dtype.str, use_cache))
+
+    def close(self):
+        self.pool.shutdown()
+        self.shm.close()
+        self.shm.unlink()
+
+    # Scores every config, returning costs in the same order. Configs are
+    # grouped by num_blocks so workers mostly hit their color cache.
+    def score(self, configs, stride=1):
+        order = sorted(range(len(configs)), key=lambda i: configs[i]['num_blocks'])
+        chunk = max(1, math.ceil(len(order) / (4 * self.jobs)))
+        futures = []
+        for start in range(0, len(order), chunk):
+            idx = order[start:start+chunk]
+            fut = self.pool.submit(score_chunk, [configs[i] for i in idx], stride)
+            futures.append((idx, fut))
+        costs = [None] * len(configs)
+        for idx, fut in futures:
+            for i, cost in zip(idx, fut.result()):
+                costs[i] = cost
+        return costs
+
+    def best(self, configs, stride=1):
+        costs = self.score(configs, stride)
+        i = min(range(len(configs)), key=costs.__getitem__)
+        return costs[i], configs[i]
+
+    # Keeps the best 1/eta of the configs after each coarse rung.
+    def halving(self, configs, eta):
+        for stride in HALVING_STRIDES[:-1]:
+            costs = self.score(configs, stride)
+            keep = max(1, math.ceil(len(configs) / eta))
+            order = sorted(range(len(configs)), key=costs.__getitem__)[:keep]
+            configs = [configs[i] for i in order]
+            paint.eprint(f'stride {stride}: kept {len(configs)}, best {costs[order[0]]}')
+        return self.best(configs)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True)
+    parser.add_argument('-o', '--output', type=str, required=True)
+    parser.add_argument('-s', '--strategy', choices=['grid', 'random', 'halving'],
+                        default='random')
+    parser.add_argument('-n', '--num_samples', type=int, default=25,
+                        help='configs to sample for random and halving')
+    parser.add_argument('--eta', type=int, default=3,
+                        help='halving keeps 1/eta of the configs per rung')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--no-cache', action='store_true', help='always re-solve grid colors')
+    args = parser.parse_args()
+    if args.no_cache:
+        paint.COLOR_CACHE = None
+
+    img = paint.load_mapped(args.input)
+    rng = random.Random(args.seed)
+    if args.strategy == 'grid':
+        configs = grid_space()
+    else:
+        configs = random_space(args.num_samples, rng)
+
+    start = time.time()
+    sweeper = Sweeper(img, args.jobs, use_cache=not args.no_cache)
+    try:
+        if args.strategy == 'halving':
+            cost, best_config = sweeper.halving(configs, args.eta)
+        else:
+            cost, best_config = sweeper.best(configs)
+    finally:
+        sweeper.close()
+    print(f'Scored {len(configs)} configs in {time.time()-start:.2f}s')
+
+    # save the version with the lowest cost
+    paint.NBLOCKS = best_config["num_blocks"]
+    cmds = paint.solve(img, best_config["orient"], (best_config["bleed_a" ], best_config["bleed_b"]))
+    with open(args.output, "w") as f:
+        f.writelines(c + "\n" for c in cmds)
+
+    print(f"Best config: {best_config}")
+    print(f'Total cost: {cost}')
+    if paint.COLOR_CACHE is not None:
+        paint.eprint(paint.COLOR_CACHE.stats())
+
+if __name__ == '__main__':
+    main()
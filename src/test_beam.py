@@ -0,0 +1,21 @@
+# Run from src/ with `python -m pytest`.
+import os
+
+import beam
+
+PROBLEM = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'problems', '5.png')
+
+# Every expanded node should fork from its parent's state and replay only its
+# own action, never the whole chain from the blank canvas.
+def test_expansions_fork_from_parent(monkeypatch):
+    expanded = []
+    expand = beam.expand
+    def counting_expand(chain, *args):
+        expanded.append(len(chain))
+        return expand(chain, *args)
+    monkeypatch.setattr(beam, 'expand', counting_expand)
+
+    planner = beam.BeamPlanner(PROBLEM, width=3, n_blocks=2, n_pos=2, jobs=1)
+    planner.search(60, patience=4)
+    assert max(expanded) >= 3
+    assert beam.REPLAYED <= len(expanded)
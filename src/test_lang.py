@@ -0,0 +1,30 @@
+# Run from src/ with `python -m pytest`.
+import pytest
+
+import lang
+import sim
+
+PROG = '''cut [0] [200, 200]
+color [0.0] [70000, 0, 0, 255]
+'''
+
+# Out-of-range colors compile and fail when the program runs, as the text does.
+def test_compiled_out_of_range_color_fails_at_execution():
+    prog = lang.compile_moves(lang.parse_program(PROG))
+    assert lang.format_program(lang.iter_compiled(prog)) == PROG
+    with pytest.raises(sim.ExecutionError):
+        sim.run_compiled(sim.blank_state(), prog)
+    with pytest.raises(sim.ExecutionError):
+        sim.run_program(sim.blank_state(), lang.parse_program(PROG))
+
+def test_compile_rejects_numbers_beyond_int32():
+    with pytest.raises(lang.ParseError):
+        lang.compile_moves(lang.parse_program('cut [0] [x] [4294967296]\n'))
+
+# Errors quote their line even when the lines came from an iterator.
+def test_execution_error_from_iterated_lines():
+    moves = lang.parse_lines(map(str, ['cut [0] [x] [500]']))
+    with pytest.raises(sim.ExecutionError) as e:
+        sim.run_program(sim.blank_state(), moves)
+    assert 'out of bounds' in str(e.value)
+    assert 'cut [0] [x] [500]' in str(e.value)
@@ -0,0 +1,31 @@
+# Run from src/ with `python -m pytest`.
+import numpy as np
+import os
+import pytest
+
+import lang
+import paint
+
+@pytest.mark.parametrize('shape', [(400, 400, 4), (7, 3, 4), (37, 4), (0, 5, 4), (5, 0, 4), (0, 4)])
+def test_diff_cost_matches_naive(shape):
+    rng = np.random.default_rng(0)
+    a = rng.integers(0, 256, shape, dtype=np.uint8)
+    b = rng.integers(0, 256, shape, dtype=np.uint8)
+    assert paint.diff_cost(a, b) == pytest.approx(paint.diff_cost_naive(a, b), rel=1e-12)
+
+# The text wrappers return lists that parse back to the same program.
+def test_solve_returns_command_list(monkeypatch):
+    img = paint.load_mapped(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', 'problems', '5.png'))
+    monkeypatch.setattr(paint, 'NBLOCKS', 4)
+    cmds = paint.solve(img, 'vertA', (0, 0))
+    assert isinstance(cmds, list) and len(cmds) > 0
+    moves = lang.parse_lines(cmds)
+    assert lang.format_program(moves) == ''.join(c + '\n' for c in cmds)
+
+def test_pyramid_levels_must_fit_the_image():
+    img = np.zeros((400, 400, 4), dtype=np.uint8)
+    assert paint.max_pyramid_levels(img.shape) == 4
+    assert [a.shape[0] for a in paint.pyramid(img, 4)] == [400, 200, 100, 50, 25]
+    with pytest.raises(ValueError):
+        paint.pyramid(img, 5)
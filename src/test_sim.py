@@ -0,0 +1,80 @@
+# Run from src/ with `python -m pytest`.
+import numpy as np
+import pytest
+
+import lang
+import paint
+import sim
+
+# Random legal moves for `state`, which the caller applies before asking for
+# the next one: cuts, colors, and swaps and merges whenever the current blocks
+# allow them.
+def random_moves(state, rng, n):
+    for _ in range(n):
+        blocks = state.blocks
+        names = sorted(blocks)
+        swaps = [(a, b) for a in names for b in names if a < b and
+                 (blocks[a].w, blocks[a].h) == (blocks[b].w, blocks[b].h)]
+        merges = []
+        for a in names:
+            for b in names:
+                ba, bb = blocks[a], blocks[b]
+                if (ba.y == bb.y and ba.h == bb.h and ba.x + ba.w == bb.x or
+                    ba.x == bb.x and ba.w == bb.w and ba.y + ba.h == bb.y):
+                    merges.append((a, b))
+        kinds = ['cut', 'cut', 'color', 'color']
+        if swaps:
+            kinds.append('swap')
+        if merges:
+            kinds.append('merge')
+        kind = kinds[rng.integers(len(kinds))]
+        if kind == 'swap':
+            a, b = swaps[rng.integers(len(swaps))]
+            yield lang.SwapMove(a, b)
+        elif kind == 'merge':
+            a, b = merges[rng.integers(len(merges))]
+            yield lang.MergeMove(a, b)
+        elif kind == 'color':
+            name = names[rng.integers(len(names))]
+            yield lang.ColorMove(name, tuple(int(c) for c in rng.integers(0, 256, 4)))
+        else:
+            name = names[rng.integers(len(names))]
+            b = blocks[name]
+            if b.w < 2 or b.h < 2:
+                continue
+            # halving half the time leaves equal blocks to swap
+            if rng.integers(2):
+                x, y = b.x + b.w // 2, b.y + b.h // 2
+            else:
+                x = int(rng.integers(b.x + 1, b.x + b.w))
+                y = int(rng.integers(b.y + 1, b.y + b.h))
+            r = rng.integers(3)
+            if r == 0:
+                yield lang.LineCutMove(name, 'x', x)
+            elif r == 1:
+                yield lang.LineCutMove(name, 'y', y)
+            else:
+                yield lang.PointCutMove(name, (x, y))
+
+@pytest.mark.parametrize('backend', sorted(sim.BACKENDS))
+@pytest.mark.parametrize('seed', range(4))
+def test_tracked_cost_matches_render(backend, seed):
+    rng = np.random.default_rng(seed)
+    ref = rng.integers(0, 256, (400, 400, 4), dtype=np.uint8)
+    state = sim.blank_state(backend=backend, ref=ref)
+    cost = 0
+    kinds = set()
+    for move in random_moves(state, rng, 80):
+        cost += state.apply(move)
+        kinds.add(type(move))
+        diff = paint.diff_cost(ref, state.render())
+        assert state.cost == cost
+        assert state.sim_cost == pytest.approx(diff, rel=1e-9)
+        assert state.total_cost() == cost + round(diff)
+    assert lang.SwapMove in kinds and lang.MergeMove in kinds
+
+def test_compute_costs_matches_compute_cost():
+    areas = np.array([0, 1, 7, 400, 1600, 12345, 160000])
+    costs = sim.compute_costs(sim.COLOR_COST, areas, 400 * 400)
+    assert costs[0] == np.inf
+    assert costs[1:].tolist() == [sim.compute_cost(sim.COLOR_COST, a, 400, 400) for a in areas[1:]]